@@ -0,0 +1,128 @@
+# Tuning benchmark for the HNSW index settings (see IndexSettings in vectordb_service)
+# Run it from the DinoAPI folder (same place you run uvicorn from):
+    # python -m app.benchmarks.hnsw_benchmark --collection dino_docs --k 5 --m 8 16 32 --search-ef 16 64 256
+
+# We copy an existing collection's vectors into throwaway collections, one per (space, M, construction_ef),
+# and for every search_ef we measure:
+    # Recall@k, using exact brute-force results as the ground truth
+    # p50/p99 query latency
+    # Index size on disk and build time (these only depend on M and construction_ef)
+# The queries are held-out vectors from the collection itself (left out of the index), so no Ollama calls
+# Nothing here touches the real collection - pick the winner, then put it in index_settings for new collections
+
+import argparse
+import itertools
+import os
+import shutil
+import tempfile
+import time
+
+import chromadb
+import numpy as np
+from chromadb.api.shared_system_client import SharedSystemClient
+
+from app.services.vectordb_service import IndexSettings, get_vector_store, get_index_settings
+
+
+# p50/p99 helper - returns milliseconds
+def percentiles(timings:list[float]) -> tuple[float, float]:
+    return float(np.percentile(timings, 50) * 1000), float(np.percentile(timings, 99) * 1000)
+
+
+# Exact top k for every query, measured the same way the index measures distance
+def brute_force(queries:np.ndarray, vectors:np.ndarray, space:str, k:int) -> np.ndarray:
+    if space == "l2":
+        scores = -((queries ** 2).sum(axis=1, keepdims=True) - 2 * queries @ vectors.T + (vectors ** 2).sum(axis=1))
+    elif space == "cosine":
+        queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+        scores = queries @ (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).T
+    else:
+        scores = queries @ vectors.T
+    return np.argsort(-scores, axis=1)[:, :k]
+
+
+# Everything in the folder except Chroma's sqlite file (which holds the documents, not the index)
+def index_bytes(directory:str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(directory)
+        for name in names
+        if name != "chroma.sqlite3"
+    )
+
+
+def run(collection:str, k:int, query_count:int, spaces:list[str], ms:list[int],
+        construction_efs:list[int], search_efs:list[int], seed:int):
+
+    data = get_vector_store(collection)._collection.get(include=["embeddings"])
+    vectors = np.asarray(data["embeddings"], dtype=np.float32)
+
+    # Hold some vectors out to use as queries
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(vectors))
+    query_count = min(query_count, len(vectors) // 2)
+    queries, indexed = vectors[order[:query_count]], vectors[order[query_count:]]
+    ids = [str(index) for index in range(len(indexed))]
+
+    print(f"'{collection}' is using {get_index_settings(get_vector_store(collection))}")
+    print(f"Indexing {len(indexed)} vectors ({vectors.shape[1]} dims), {len(queries)} held-out queries, k={k}\n")
+    print(f"{'space':<8}{'M':>4}{'build_ef':>10}{'search_ef':>11}{'recall@' + str(k):>11}"
+          f"{'p50 ms':>9}{'p99 ms':>9}{'index MB':>10}{'build s':>9}")
+
+    truths = {space: brute_force(queries, indexed, space, k) for space in spaces}
+
+    for space, m, construction_ef in itertools.product(spaces, ms, construction_efs):
+
+        # Fresh folder per index, so its size on disk is just this index
+        directory = tempfile.mkdtemp(prefix="hnsw_benchmark_")
+        try:
+            client = chromadb.PersistentClient(path=directory)
+            settings = IndexSettings(space=space, M=m, construction_ef=construction_ef, search_ef=search_efs[0])
+            chroma_collection = client.create_collection("hnsw_benchmark", metadata=settings.to_metadata())
+
+            start = time.perf_counter()
+            batch_size = client.get_max_batch_size()
+            for batch_start in range(0, len(indexed), batch_size):
+                batch_end = batch_start + batch_size
+                chroma_collection.add(ids=ids[batch_start:batch_end], embeddings=indexed[batch_start:batch_end])
+            build_seconds = time.perf_counter() - start
+            size_mb = index_bytes(directory) / 1e6
+
+            for search_ef in search_efs:
+                chroma_collection.modify(configuration={"hnsw": {"ef_search": search_ef}})
+
+                # A loaded index keeps its old search_ef, so drop Chroma's cached client and load the index fresh
+                SharedSystemClient.clear_system_cache()
+                chroma_collection = chromadb.PersistentClient(path=directory).get_collection("hnsw_benchmark")
+                chroma_collection.query(query_embeddings=[queries[0]], n_results=k, include=[]) # Warm up (loads the index)
+
+                # One query at a time, like a real search
+                timings, found = [], []
+                for query in queries:
+                    start = time.perf_counter()
+                    result = chroma_collection.query(query_embeddings=[query], n_results=k, include=[])
+                    timings.append(time.perf_counter() - start)
+                    found.append({int(result_id) for result_id in result["ids"][0]})
+
+                truth = truths[space]
+                recall = np.mean([len(found[row] & set(truth[row])) / k for row in range(len(queries))])
+                p50, p99 = percentiles(timings)
+                print(f"{space:<8}{m:>4}{construction_ef:>10}{search_ef:>11}{recall:>11.3f}"
+                      f"{p50:>9.3f}{p99:>9.3f}{size_mb:>10.2f}{build_seconds:>9.2f}")
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sweep HNSW index settings for recall, latency, size and build time")
+    parser.add_argument("--collection", default="dino_docs")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--queries", type=int, default=100, help="How many vectors to hold out as queries")
+    parser.add_argument("--space", nargs="+", default=["l2"], choices=["l2", "cosine", "ip"])
+    parser.add_argument("--m", nargs="+", type=int, default=[8, 16, 32])
+    parser.add_argument("--construction-ef", nargs="+", type=int, default=[64, 100, 200])
+    parser.add_argument("--search-ef", nargs="+", type=int, default=[10, 25, 50, 100, 200])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    run(args.collection, args.k, args.queries, args.space, args.m, args.construction_ef, args.search_ef, args.seed)
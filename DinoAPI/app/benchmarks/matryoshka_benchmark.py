@@ -0,0 +1,90 @@
+# Recall/latency report for Matryoshka truncation of an existing (full width) collection
+# Run it from the DinoAPI folder BEFORE migrating a collection:
+    # python -m app.benchmarks.matryoshka_benchmark --collection dino_docs --k 5
+
+# For each truncated dimension we measure:
+    # Recall@k - how many of the full 768-dim top k results the truncated vectors still find
+    # Brute-force scan latency per query (p50/p99) - the search cost that shrinks with the dimension
+    # Vector storage size
+# Queries are sampled from the collection's own stored vectors (each query's own chunk is left out),
+# so the report doesn't need a single call to Ollama
+# Everything is ranked in the collection's OWN distance space (its hnsw:space), so the baseline is exactly
+# what the full width collection returns today, and the migrated collection keeps that space too
+
+import argparse
+import time
+
+import numpy as np
+
+from app.services.vectordb_service import (
+    EMBEDDING_FULL_DIMENSION, MATRYOSHKA_DIMENSIONS, get_vector_store, get_embedding_dimension, get_index_settings,
+    truncate_vectors
+)
+
+
+# Distances from each query to every vector in one of Chroma's spaces (lower is more similar, same as Chroma):
+    # "l2" = squared L2 distance, "ip" = 1 - dot product, "cosine" = 1 - cosine similarity
+def distances(queries:np.ndarray, vectors:np.ndarray, space:str) -> np.ndarray:
+    if space == "l2":
+        return (queries ** 2).sum(axis=-1, keepdims=True) - 2.0 * (queries @ vectors.T) + (vectors ** 2).sum(axis=1)
+    if space == "cosine":
+        queries = queries / np.linalg.norm(queries, axis=-1, keepdims=True)
+        vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    return 1.0 - queries @ vectors.T
+
+
+# Indexes of the k nearest vectors to each query, in the collection's space
+def nearest(queries:np.ndarray, vectors:np.ndarray, query_indexes:np.ndarray, k:int, space:str) -> np.ndarray:
+    scores = distances(queries, vectors, space)
+    scores[np.arange(len(query_indexes)), query_indexes] = np.inf # Don't let a chunk find itself
+    return np.argsort(scores, axis=1)[:, :k]
+
+
+def run(collection:str, k:int, sample:int, seed:int):
+
+    store = get_vector_store(collection)
+    if get_embedding_dimension(store) != EMBEDDING_FULL_DIMENSION:
+        raise ValueError(f"Collection '{collection}' is already truncated - run this on a full width collection")
+    space = get_index_settings(store).space
+    data = store._collection.get(include=["embeddings"])
+
+    # The baseline is what the full width collection searches with: its raw stored vectors, in its own space
+    full = np.asarray(data["embeddings"], dtype=np.float32)
+    full_dimension = full.shape[1]
+
+    rng = np.random.default_rng(seed)
+    query_indexes = rng.choice(len(full), size=min(sample, len(full)), replace=False)
+    truth = nearest(full[query_indexes], full, query_indexes, k, space)
+
+    print(f"{len(full)} vectors in '{collection}' ({space} space), {len(query_indexes)} sample queries, k={k}\n")
+    print(f"{'dims':>6}{'recall@' + str(k):>12}{'p50 ms':>10}{'p99 ms':>10}{'storage MB':>12}")
+
+    for dimension in (full_dimension,) + tuple(d for d in MATRYOSHKA_DIMENSIONS if d < full_dimension):
+        # Truncated vectors get the exact transform a migrated collection stores (layer norm, slice, normalize)
+        # and get searched in the same space, since the migration copies the index settings over
+        vectors = full if dimension == full_dimension else np.asarray(truncate_vectors(full, dimension), dtype=np.float32)
+        found = nearest(vectors[query_indexes], vectors, query_indexes, k, space)
+        recall = np.mean([len(set(found[row]) & set(truth[row])) / k for row in range(len(query_indexes))])
+
+        # Time a brute-force scan for each query on its own (like a real search would)
+        # Every space boils down to one matrix-vector multiply (norms get computed once, up front), so we time just that
+        timings = []
+        for query_index in query_indexes:
+            start = time.perf_counter()
+            scores = vectors @ vectors[query_index]
+            np.argpartition(-scores, k)
+            timings.append(time.perf_counter() - start)
+
+        p50, p99 = np.percentile(timings, 50) * 1000, np.percentile(timings, 99) * 1000
+        print(f"{dimension:>6}{recall:>12.3f}{p50:>10.3f}{p99:>10.3f}{vectors.nbytes / 1e6:>12.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Matryoshka truncation recall/latency report")
+    parser.add_argument("--collection", default="dino_docs")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--sample", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    run(args.collection, args.k, args.sample, args.seed)
@@ -0,0 +1,77 @@
+# Benchmark that compares the NumPy search backend against Chroma
+# Run it from the DinoAPI folder (same place you run uvicorn from):
+    # python -m app.benchmarks.numpy_search_benchmark --collection dino_docs --k 5
+
+# For every query we measure:
+    # Latency of Chroma and the exact float32 NumPy search
+    # Recall@k of Chroma, using the exact NumPy results as the ground truth
+# The queries are embedded ONCE up front so we only time the search itself, not Ollama
+
+import argparse
+import time
+
+import numpy as np
+
+from app.services import numpy_search_service
+from app.services.vectordb_service import EMBEDDING, get_vector_store, get_index_settings
+
+DEFAULT_QUERIES = [
+    "What is someone's favorite dinosaur?",
+    "Who likes the T Rex?",
+    "Which dinosaurs lived in the Cretaceous?",
+    "When is the next dig?",
+    "What are the boss's plans for the summer?",
+    "Where are we excavating next?"
+]
+
+
+# p50/p99 helper - returns milliseconds
+def percentiles(timings:list[float]) -> tuple[float, float]:
+    return float(np.percentile(timings, 50) * 1000), float(np.percentile(timings, 99) * 1000)
+
+
+def run(collection:str, k:int, repeats:int, queries:list[str]):
+
+    store = get_vector_store(collection)
+
+    # Make sure the NumPy export is fresh before comparing
+    count = numpy_search_service.export_collection(collection, store, get_index_settings(store).space)
+    print(f"Exported {count} vectors from '{collection}'")
+
+    query_vectors = EMBEDDING.embed_documents(queries)
+
+    timings = {"chroma": [], "numpy_exact": []}
+    recalls = {"chroma": []}
+
+    for query_vector in query_vectors:
+        for _ in range(repeats):
+
+            start = time.perf_counter()
+            chroma_results = store.similarity_search_by_vector_with_relevance_scores(query_vector, k=k)
+            timings["chroma"].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            exact_results = numpy_search_service.search_vector(collection, query_vector, k)
+            timings["numpy_exact"].append(time.perf_counter() - start)
+
+        # Recall = how many of the TRUE top k did each backend find?
+        truth = {result["text"] for result in exact_results}
+        if truth:
+            recalls["chroma"].append(len(truth & {doc.page_content for doc, _ in chroma_results}) / len(truth))
+
+    print(f"\n{'backend':<14}{'p50 ms':>10}{'p99 ms':>10}{'recall@' + str(k):>12}")
+    for backend, backend_timings in timings.items():
+        p50, p99 = percentiles(backend_timings)
+        recall = np.mean(recalls[backend]) if recalls.get(backend) else 1.0
+        print(f"{backend:<14}{p50:>10.3f}{p99:>10.3f}{recall:>12.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare NumPy vs Chroma search latency and recall")
+    parser.add_argument("--collection", default="dino_docs")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--queries", nargs="*", default=DEFAULT_QUERIES)
+    args = parser.parse_args()
+
+    run(args.collection, args.k, args.repeats, args.queries)
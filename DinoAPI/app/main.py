@@ -1,14 +1,39 @@
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
 
-from app.routers import dino_router, user_router, langchain_ops, vectordb_ops, langgraph_ops
+from fastapi import FastAPI, Request
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse
+
+from app.responses import FastJSONResponse
+from app.routers import dino_router, user_router, langchain_ops, vectordb_ops, langgraph_ops, debug_router
+from app.services import ingest_job_service, tracing_service, ollama_client_service, model_cascade_service
+from app.services.admission_service import AdmissionRejected
+from app.services.cancellation_service import RequestCancelled
 from app.services.db_connection import Base, engine
+from app.services.vectordb_service import EMBEDDING_MODEL, flush_numpy_exports
 
 # Create the DB tables on startup (if they don't already exist)
 Base.metadata.create_all(bind=engine)
 
+# The LIFESPAN runs code when the app starts up (before the yield) and shuts down (after the yield)
+@asynccontextmanager
+async def lifespan(app:FastAPI):
+    # Get Ollama to load our models now, instead of on the first request
+    ollama_client_service.start_preload(model_cascade_service.configured_models(), [EMBEDDING_MODEL])
+    # Start the background ingestion workers
+    ingest_job_service.start_workers()
+    yield
+    ingest_job_service.stop_workers()
+    # Re-exports that were still waiting to coalesce run now, so the NumPy backend doesn't stay stale
+    flush_numpy_exports()
+
 # Set up our FastAPI instance.
 # This "app" variable will be used to do FastAPI stuff like defining endpoints and routers
-app = FastAPI()
+# default_response_class=FastJSONResponse makes EVERY router serialize with orjson (when it's installed)
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
+
+# Gzip responses bigger than 1KB (big lists of users/dinos/search results shrink a LOT)
+app.add_middleware(GZipMiddleware, minimum_size=1000)
 
 # REGISTER my routers (so they actually show up in SwaggerUI)
 app.include_router(dino_router.router)
@@ -16,6 +41,46 @@ app.include_router(user_router.router)
 app.include_router(langchain_ops.router)
 app.include_router(vectordb_ops.router)
 app.include_router(langgraph_ops.router)
+app.include_router(debug_router.router)
+
+# MIDDLEWARE runs around every request - this one records the request's trace
+# The trace ID comes back in the X-Trace-Id header, so you can look it up at /debug/traces/{trace_id}
+@app.middleware("http")
+async def trace_requests(request:Request, call_next):
+    trace_id, root, token = tracing_service.start_trace(request.method, request.url.path)
+    try:
+        response = await call_next(request)
+    except BaseException:
+        tracing_service.finish_trace(trace_id, root, token, 500)
+        raise
+    tracing_service.current_span.reset(token)
+    response.headers["X-Trace-Id"] = trace_id
+
+    # call_next returns as soon as the HEADERS are ready - a streamed response (like refined-chat?stream=true)
+    # is still running its LLM calls after that. So the trace only gets finished once the body is all sent
+    body = response.body_iterator
+    async def traced_body():
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            tracing_service.finish_trace(trace_id, root, None, response.status_code)
+    response.body_iterator = traced_body()
+    return response
+
+# When the admission controller turns a request away, send a fast 429/503 that tells the client when to retry
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request:Request, e:AdmissionRejected):
+    return JSONResponse(
+        status_code=e.status_code,
+        content={"detail": e.detail},
+        headers={"Retry-After": str(e.retry_after)}
+    )
+
+# A cancelled request gets a 504 if it ran out of time (or a 499 if the client left, which nobody will see)
+@app.exception_handler(RequestCancelled)
+async def request_cancelled_handler(request:Request, e:RequestCancelled):
+    return JSONResponse(status_code=e.status_code, content={"detail": str(e)})
 
 # Generic sample endpoint (greeting GET request)
 @app.get("/")
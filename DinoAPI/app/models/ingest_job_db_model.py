@@ -0,0 +1,55 @@
+from sqlalchemy import Column, Integer, String, Text, Float
+
+from app.services.db_connection import Base
+
+
+# This table is the persistent QUEUE for background ingestion jobs
+# Since it lives in app.db (SQLite), queued jobs survive a server restart
+class IngestJobDBModel(Base):
+
+    __tablename__ = "ingest_jobs"
+
+    id = Column(Integer, primary_key=True)
+    collection = Column(String, nullable=False)
+    text = Column(Text, nullable=False)
+
+    # Higher priority jobs get picked up first (see PRIORITIES in the ingest_job_service)
+    priority = Column(Integer, nullable=False, default=0)
+
+    # queued -> running -> done/failed (or cancelled at any point)
+    status = Column(String, nullable=False, default="queued")
+
+    # Retry bookkeeping - failed jobs go back in the queue until they run out of attempts
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=3)
+    next_run_at = Column(Float, nullable=False, default=0.0) # Unix timestamp - used for backoff
+    heartbeat_at = Column(Float, nullable=True) # Last time a worker touched a running job
+
+    # Progress, so the status endpoint can tell how far along a job is
+    chunks_total = Column(Integer, nullable=True)
+    chunks_done = Column(Integer, nullable=False, default=0)
+    error = Column(Text, nullable=True)
+
+    created_at = Column(Float, nullable=False)
+    updated_at = Column(Float, nullable=False)
+
+
+# The embeddings-per-second TOKEN BUCKET for background ingestion (just one row, id=1)
+# It lives in app.db instead of in memory so every uvicorn worker process shares the same limit
+class IngestRateLimitDBModel(Base):
+
+    __tablename__ = "ingest_rate_limit"
+
+    id = Column(Integer, primary_key=True)
+    tokens = Column(Float, nullable=False)
+    updated_at = Column(Float, nullable=False) # Unix timestamp of the last refill
+
+
+# One row per interactive (chat/RAG) request in flight, in ANY worker process
+# While there are rows here, bulk ingestion pauses between batches (see ingest_job_service)
+class InteractiveRequestDBModel(Base):
+
+    __tablename__ = "interactive_requests"
+
+    id = Column(Integer, primary_key=True)
+    started_at = Column(Float, nullable=False) # Unix timestamp - rows from crashed workers get ignored once they're old
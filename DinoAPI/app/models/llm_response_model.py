@@ -0,0 +1,40 @@
+from langchain_core.messages import AIMessage
+from pydantic import BaseModel
+
+
+# LEAN response models for our LLM endpoints
+# Returning the raw AIMessage sends the client a TON of metadata it doesn't need
+# (response_metadata, additional_kwargs, etc.) and makes FastAPI do extra work to serialize it
+# These models only carry the answer, the token counts, and how long the LLM took
+
+class TokenUsage(BaseModel):
+    prompt_tokens: int
+    completion_tokens: int
+    total_tokens: int
+
+
+class LLMResponseModel(BaseModel):
+    content: str
+    usage: TokenUsage | None = None
+    duration_ms: float | None = None # How long Ollama spent on the generation
+
+    # Build the lean model out of an AIMessage that came back from a chain
+    @classmethod
+    def from_ai_message(cls, message:AIMessage) -> "LLMResponseModel":
+
+        usage = None
+        if message.usage_metadata:
+            usage = TokenUsage(
+                prompt_tokens=message.usage_metadata["input_tokens"],
+                completion_tokens=message.usage_metadata["output_tokens"],
+                total_tokens=message.usage_metadata["total_tokens"]
+            )
+
+        # Ollama reports its timing in nanoseconds
+        total_duration = message.response_metadata.get("total_duration")
+
+        return cls(
+            content=message.text,
+            usage=usage,
+            duration_ms=total_duration / 1_000_000 if total_duration else None
+        )
@@ -0,0 +1,45 @@
+import json
+
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# orjson is a MUCH faster JSON library (written in Rust), but it's optional
+# If it isn't installed, we just fall back to the standard json module
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# The app's default response class (see main.py) - serializes with orjson when it's available
+class FastJSONResponse(JSONResponse):
+
+    def render(self, content) -> bytes:
+        if orjson is None:
+            return super().render(content)
+        # OPT_SERIALIZE_NUMPY lets us return NumPy numbers (like search scores) without converting them first
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+
+# Turn one item into a line of newline-delimited JSON
+def ndjson_line(item) -> bytes:
+    if orjson is None:
+        return (json.dumps(item) + "\n").encode("utf-8")
+    return orjson.dumps(item, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_SERIALIZE_NUMPY)
+
+
+# Streaming response for newline-delimited JSON (one JSON object per line)
+# Content-Encoding is set so the GZip middleware leaves it alone - gzip buffers data,
+# which would hold our lines back instead of streaming them as they're ready
+def ndjson_response(items) -> StreamingResponse:
+
+    # Works with both normal generators and async generators
+    if hasattr(items, "__aiter__"):
+        async def lines():
+            async for item in items:
+                yield ndjson_line(item)
+    else:
+        def lines():
+            for item in items:
+                yield ndjson_line(item)
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson", headers={"Content-Encoding": "identity"})
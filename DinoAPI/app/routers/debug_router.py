@@ -0,0 +1,46 @@
+from fastapi import APIRouter, HTTPException
+
+from app.services.admission_service import controller
+from app.services.agentic_langgraph_service import get_speculation_stats
+from app.services.cancellation_service import get_cancellation_stats
+from app.services.model_cascade_service import get_cascade_stats
+from app.services.tracing_service import get_trace, list_traces
+
+# Router for endpoints that help us see what the server is doing under the hood
+router = APIRouter(
+    prefix="/debug",
+    tags=["debug"]
+)
+
+# How busy is the LLM? (running/waiting generations, plus admitted/rejected counts)
+@router.get("/admission")
+async def admission_stats():
+    return controller.snapshot()
+
+# List the traces we're holding on to (the most recent sampled ones, plus the slowest ones)
+@router.get("/traces")
+async def all_traces():
+    return list_traces()
+
+# Get one request's full span tree (the "waterfall")
+@router.get("/traces/{trace_id}")
+async def trace_by_id(trace_id:str):
+    trace = get_trace(trace_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail=f"Trace with ID {trace_id} not found!")
+    return trace
+
+# How often the agentic router's speculative searches get used (hit rate) vs thrown away (waste rate)
+@router.get("/speculation")
+async def speculation_stats():
+    return get_speculation_stats()
+
+# How many requests got cancelled for missing their deadline or losing their client (total and per route)
+@router.get("/cancellations")
+async def cancellation_stats():
+    return get_cancellation_stats()
+
+# How the model cascade is splitting the work: calls/tokens/time per tier, escalations, and the per-node settings
+@router.get("/models")
+async def model_stats():
+    return get_cascade_stats()
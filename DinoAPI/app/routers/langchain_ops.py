@@ -1,15 +1,24 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from langchain_community.document_loaders import TextLoader
 from langchain_core.output_parsers import PydanticOutputParser
 from pydantic import BaseModel
 
 from app.models.dino_model import DinoModel
-from app.services.langchain_service import get_basic_chain, get_sequential_chain, get_memory_chain
+from app.models.llm_response_model import LLMResponseModel
+from app.responses import ndjson_response
+from app.services.admission_service import admission
+from app.services.cancellation_service import run_cancellable, stream_cancellable
+from app.services.ingest_job_service import interactive_traffic
+from app.services.langchain_service import get_basic_chain, get_sequential_chain, get_memory_chain, \
+    get_dino_recommendation, stream_refined_answer
 
 # Same old router setup
 router = APIRouter(
     prefix="/langchain",
-    tags=["langchain"]
+    tags=["langchain"],
+    # Every endpoint here is interactive chat, so background ingestion pauses while they run
+    dependencies=[Depends(interactive_traffic)]
 )
 
 # I'm going to make a quick Pydantic model that will represent the user's input
@@ -23,14 +32,18 @@ refined_answer_chain = get_sequential_chain()
 memory_chain = get_memory_chain()
 
 # General chat endpoint with no memory or any other fancy features
-@router.post("/chat")
-async def general_chat(chat:ChatInputModel):
+# response_model=LLMResponseModel means we only send back the answer, token usage, and timing
+# Every LLM call here goes through run_cancellable, which stops the chain (and the Ollama generation)
+# if the client disconnects or the request's deadline passes (see cancellation_service)
+@router.post("/chat", response_model=LLMResponseModel, dependencies=[Depends(admission("chat"))])
+async def general_chat(chat:ChatInputModel, request:Request):
     # Now we just invoke the chain with the user's input!
-    return basic_chain.invoke(input={"input":chat.input})
+    # (ainvoke is the async version - it lets other requests run while we wait on the LLM)
+    return LLMResponseModel.from_ai_message(await run_cancellable(request, basic_chain.ainvoke(input={"input":chat.input})))
 
 # A DOCUMENT LOADING EXAMPLE - summarizing a txt file about a hypothetical dino fight
-@router.get("/summarize")
-async def summarize_dino_fight():
+@router.get("/summarize", response_model=LLMResponseModel, dependencies=[Depends(admission("summarize"))])
+async def summarize_dino_fight(request:Request):
 
     # Use LangChain's TextLoader to load in the .txt file
     loader = TextLoader("app/DinoFightToSummarize.txt")
@@ -40,23 +53,41 @@ async def summarize_dino_fight():
     text = doc[0].page_content # Just a string with the .txt file's content
 
     # Invoke the LLM and return the summary thanks to a basic prompt
-    return basic_chain.invoke(input={"input": f"Summarize this text: {text}"})
+    summary = await run_cancellable(request, basic_chain.ainvoke(input={"input": f"Summarize this text: {text}"}))
+    return LLMResponseModel.from_ai_message(summary)
 
 # This endpoint is for the more professional chat using our sequential chain
-@router.post("/refined-chat")
-async def refined_chat(chat:ChatInputModel):
-    return refined_answer_chain.invoke(input={"input":chat.input})
+# stream=true streams the draft, then the refined answer, as newline-delimited JSON events
+    # (see stream_refined_answer in the langchain_service for what the events look like)
+@router.post("/refined-chat", response_model=LLMResponseModel, dependencies=[Depends(admission("chat"))])
+async def refined_chat(chat:ChatInputModel, request:Request, stream:bool=False):
+
+    if stream:
+        return ndjson_response(stream_cancellable(request, stream_refined_answer(chat.input)))
+
+    return LLMResponseModel.from_ai_message(
+        await run_cancellable(request, refined_answer_chain.ainvoke(input={"input":chat.input}))
+    )
 
 # This endpoint is just a chat endpoint WITH MEMORY!
-@router.post("/memory-chat")
-async def memory_chat(chat:ChatInputModel):
+@router.post("/memory-chat", dependencies=[Depends(admission("chat"))])
+async def memory_chat(chat:ChatInputModel, request:Request):
     # Just a one liner - The chain will remember the last "k" interactions automatically
-    return memory_chain.invoke(input={"input":chat.input})
+    return await run_cancellable(request, memory_chain.ainvoke(input={"input":chat.input}))
 
 # This endpoint uses an OUTPUT PARSER (PydanticOutputParser)
 # ...to send dino recommendations in Pydantic model format instead of raw text
-@router.post("/dino-recs")
-async def dino_recs(chat:ChatInputModel):
+# structured=true uses schema-constrained generation and returns a validated DinoModel instead
+@router.post("/dino-recs", response_model=LLMResponseModel | DinoModel, dependencies=[Depends(admission("chat"))])
+async def dino_recs(chat:ChatInputModel, request:Request, structured:bool=False):
+
+    # STRUCTURED MODE: the service forces the LLM to follow DinoModel's schema, validates, and caches
+    if structured:
+        try:
+            # run_in_threadpool so the (blocking) repair loop doesn't freeze the other requests
+            return await run_cancellable(request, run_in_threadpool(get_dino_recommendation, chat.input))
+        except ValueError as e:
+            raise HTTPException(status_code=502, detail=str(e))
 
     # Define a new prompt that instructs the LLM to give dino recommendations
     # in a specific format we can use to turn into Pydantic
@@ -78,9 +109,9 @@ async def dino_recs(chat:ChatInputModel):
         return ONLY the json, no extra text """
 
     # Store the response for parsing
-    response = basic_chain.invoke(input={"input": rec_prompt})
+    response = await run_cancellable(request, basic_chain.ainvoke(input={"input": rec_prompt}))
 
-    return response
+    return LLMResponseModel.from_ai_message(response)
 
     # # Pydantic has its own output parser in LangChain
     # parser = PydanticOutputParser(pydantic_object=DinoModel)
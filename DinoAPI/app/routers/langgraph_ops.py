@@ -1,14 +1,22 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends, Request
 from pydantic import BaseModel
 
+from app.services.admission_service import admission
+from app.services.cancellation_service import run_cancellable
+from app.services.ingest_job_service import interactive_traffic
 from app.services.agentic_langgraph_service import agentic_graph
 from app.services.langgraph_service import langgraph
 
 router = APIRouter(
     prefix="/langgraph",
-    tags=["langgraph"]
+    tags=["langgraph"],
+    # Every endpoint here is interactive chat, so background ingestion pauses while they run
+    dependencies=[Depends(interactive_traffic)]
 )
 
+# Both graphs can do retrieval before answering, so they're admitted as "rag" traffic
+graph_admission = [Depends(admission("rag"))]
+
 # Helper model like we did for langchain and vector ops
 class ChatInputModel(BaseModel):
     input:str
@@ -17,10 +25,11 @@ class ChatInputModel(BaseModel):
     # Return a response about fav dinos
     # Return a reponse about boss's dig plans
     # General chat
-@router.post("/langgraph")
-async def langgraph_chat(chat:ChatInputModel):
+@router.post("/langgraph", dependencies=graph_admission)
+async def langgraph_chat(chat:ChatInputModel, request:Request):
 
-    result = langgraph.invoke({"query":chat.input})
+    # run_cancellable stops the graph if the client leaves or the deadline passes (see cancellation_service)
+    result = await run_cancellable(request, langgraph.ainvoke({"query":chat.input}))
 
     return {
         "route": result.get("route"),
@@ -29,10 +38,10 @@ async def langgraph_chat(chat:ChatInputModel):
 
 # Same as above, but we're calling the AGENTIC ROUTER now!
 # It'll choose which tool to call, then proceed pretty much the same as the old one
-@router.post("/agentic-langgraph")
-async def agentic_langgraph_chat(chat:ChatInputModel):
+@router.post("/agentic-langgraph", dependencies=graph_admission)
+async def agentic_langgraph_chat(chat:ChatInputModel, request:Request):
 
-    result = agentic_graph.invoke({"query":chat.input})
+    result = await run_cancellable(request, agentic_graph.ainvoke({"query":chat.input}))
 
     return {
         "route": result.get("route"),
@@ -1,9 +1,13 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request
 from sqlalchemy.orm import Session
 
 from app.models.user_db_model import UserDBModel, CreateUserModel
+from app.models.llm_response_model import LLMResponseModel
 from app.models.user_model import UserModel
+from app.services.admission_service import admission
+from app.services.cancellation_service import run_cancellable
 from app.services.db_connection import get_db
+from app.services.ingest_job_service import interactive_traffic
 from app.services.langchain_service import get_basic_chain
 
 # Same old Router Setup
@@ -91,8 +95,9 @@ async def delete_user(user_id:int, db: Session = Depends(get_db)):
 
 # RAG (Retrieval Augmented Generated) with our LLM and user data
 # AUGMENTING the GENERATED response based on some data we're RETRIEVING
-@router.post("/rag")
-async def users_rag(user_input:str, db: Session = Depends(get_db)):
+# (interactive_traffic makes background ingestion pause while it's running, like the other LLM endpoints)
+@router.post("/rag", response_model=LLMResponseModel, dependencies=[Depends(interactive_traffic), Depends(admission("rag"))])
+async def users_rag(user_input:str, request:Request, db: Session = Depends(get_db)):
 
     # NOTE: we didn't make user_input a Pydantic model
     # ...which is fine, but the user's question will come in as a query param
@@ -106,12 +111,12 @@ async def users_rag(user_input:str, db: Session = Depends(get_db)):
     # Get the basic chain from the langchain service
     chain = get_basic_chain()
 
-    # Ask the LLM a question based on that user info
-    response = chain.invoke(
+    # Ask the LLM a question based on that user info (cancelled if the client leaves or time runs out)
+    response = await run_cancellable(request, chain.ainvoke(
         {"input": f"""Here is some information about users in our database: {user_info}
             Based on this information, answer the user's query: {user_input} """}
-    )
+    ))
 
-    # Return the LLM's response!
-    return response
+    # Return the LLM's response! (just the content, token usage, and timing)
+    return LLMResponseModel.from_ai_message(response)
 
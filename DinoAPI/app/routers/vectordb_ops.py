@@ -1,8 +1,18 @@
-from fastapi import APIRouter
-from pydantic import BaseModel
-
+from chromadb.errors import ChromaError
+from fastapi import APIRouter, HTTPException, Depends, Request
+from pydantic import BaseModel, Field
+
+from app.models.llm_response_model import LLMResponseModel
+from app.responses import ndjson_response
+from app.services.admission_service import admission
+from app.services.cancellation_service import run_cancellable
+from app.services.chunking_service import ChunkProfile
+from app.services.ingest_job_service import submit_job, get_job, cancel_job, interactive_traffic, PRIORITIES
 from app.services.langchain_service import get_basic_chain
-from app.services.vectordb_service import ingest_text, search
+from app.services.vectordb_service import (
+    search, export_to_numpy, search_many, get_vector_store, get_index_settings, set_search_ef,
+    get_chunk_profile, set_chunk_profile, collection_exists
+)
 
 router = APIRouter(
     prefix="/vector",
@@ -13,10 +23,31 @@ router = APIRouter(
 class IngestTextRequest(BaseModel):
     text: str
 
+# Model for background ingestion jobs (priority is "low", "normal", or "high")
+class IngestJobRequest(BaseModel):
+    text: str
+    priority: str = "normal"
+
 # Another quick model for similarity search requests
 class SearchRequest(BaseModel):
     query: str
     k:int = 6
+    backend:str = None # "chroma" or "numpy" - leave empty to use the server default
+
+# Models for batch search - each query can optionally override k and the collection
+class BatchQuery(BaseModel):
+    query: str
+    k:int = Field(default=None, gt=0)
+    collection:str = None
+
+class BatchSearchRequest(BaseModel):
+    queries: list[BatchQuery]
+    k:int = Field(default=6, gt=0) # Default k for queries that don't set their own
+    backend:str = None
+
+# Model for changing a collection's HNSW search_ef (must be at least 1)
+class SearchEfRequest(BaseModel):
+    search_ef: int = Field(gt=0)
 
 # Last quick model for LLM queries
 class ChatInputModel(BaseModel):
@@ -28,20 +59,102 @@ basic_chain = get_basic_chain()
 # Endpoint that ingests text
 # User will pass in "dino_docs" or "plans_docs" depending on the collection they need
     # (Realistically, the front end would automatically supply the collection to use)
-@router.post("/ingest-text")
+# The chunking + embedding happens in a normal priority background job (same as /ingest-jobs below),
+# so a big ingest can't tie up the request or fight chat traffic for Ollama
+# Returns the job right away (202 ACCEPTED) - check on it with /ingest-jobs/{job_id}
+@router.post("/ingest-text", status_code=202)
 async def ingest_user_text(collection:str, input:IngestTextRequest):
-    count = ingest_text(collection, input.text)
-    return {f"ingested chunks: {count}"}
+    return submit_job(collection, input.text)
+
+# Endpoints that get/set how a collection's text gets chunked (chunk size and overlap, in tokens)
+# The profile gets saved with the collection, so it sticks around after a restart
+# (Looking up a profile doesn't create the collection - unknown collections are a 404)
+@router.get("/chunk-profiles/{collection}")
+async def chunk_profile(collection:str):
+    if not collection_exists(collection):
+        raise HTTPException(status_code=404, detail=f"Collection '{collection}' not found!")
+    return get_chunk_profile(collection)
+
+@router.put("/chunk-profiles/{collection}")
+async def update_chunk_profile(collection:str, profile:ChunkProfile):
+    return set_chunk_profile(collection, profile)
+
+# Endpoints to see a collection's HNSW index settings, and change its search_ef
+# (search_ef is the only one that can change after the collection is created)
+@router.get("/index-settings/{collection}")
+async def index_settings(collection:str):
+    return get_index_settings(get_vector_store(collection))
+
+@router.put("/index-settings/{collection}/search-ef")
+async def update_search_ef(collection:str, input:SearchEfRequest):
+    return set_search_ef(collection, input.search_ef)
+
+# Endpoint that ingests text in the BACKGROUND
+# Returns a job right away (202 ACCEPTED) - check on it with the status endpoint below
+@router.post("/ingest-jobs", status_code=202)
+async def submit_ingest_job(collection:str, input:IngestJobRequest):
+    if input.priority not in PRIORITIES:
+        raise HTTPException(status_code=400, detail=f"Priority must be one of {list(PRIORITIES)}")
+    return submit_job(collection, input.text, input.priority)
+
+# Endpoint that gets the status of a background ingestion job
+@router.get("/ingest-jobs/{job_id}")
+async def ingest_job_status(job_id:int):
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Ingest job with ID {job_id} not found!")
+    return job
+
+# Endpoint that cancels a background ingestion job
+@router.post("/ingest-jobs/{job_id}/cancel")
+async def cancel_ingest_job(job_id:int):
+    job = cancel_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Ingest job with ID {job_id} not found!")
+    return job
 
 # Endpoint that does a similarity based on a user's query
 @router.post("/search")
 async def similarity_search(collection:str, request:SearchRequest):
-    return search(collection, request.query, request.k)
+    return search(collection, request.query, request.k, request.backend)
+
+# Endpoint that does MANY similarity searches in one request
+# All queries get embedded up front (in parallel over the embedding connection pool), and each collection gets queried once
+# Results stream back as newline-delimited JSON (one line per query) as soon as they're ready
+    # Each line looks like: {"index": 0, "results": [...]} where index is the query's position in the request
+    # If a collection's search fails mid-stream, its queries get {"index": 0, "error": "..."} lines instead
+# Bad input (like a collection name Chroma won't accept) gets caught BEFORE the stream starts, so it's a normal 400
+@router.post("/search-batch")
+async def batch_similarity_search(request:BatchSearchRequest, collection:str = None):
+
+    queries = [query.model_dump() for query in request.queries]
+
+    # Every query needs a collection - either its own or the default one
+    if collection is None and any(query["collection"] is None for query in queries):
+        raise HTTPException(status_code=400, detail="Every query needs a collection (or pass a default collection)")
+
+    try:
+        results = search_many(queries, collection, request.k, request.backend)
+    except (ValueError, ChromaError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return ndjson_response(
+        {"index": index, "results": result} if error is None else {"index": index, "error": error}
+        for index, result, error in results
+    )
+
+# Endpoint that exports a collection to the NumPy search backend
+# Once exported, searches with backend="numpy" use the memory-mapped matrices instead of Chroma
+@router.post("/export-numpy")
+async def export_numpy(collection:str):
+    count = export_to_numpy(collection)
+    return {"collection": collection, "exported_vectors": count}
 
 
 # Endpoint for querying the LLM about the dino docs (general chat-ish)
-@router.post("/dino-doc-rag")
-async def dino_doc_rag(chat:ChatInputModel):
+# (interactive_traffic makes background ingestion pause while these LLM endpoints are running)
+@router.post("/dino-doc-rag", response_model=LLMResponseModel, dependencies=[Depends(interactive_traffic), Depends(admission("rag"))])
+async def dino_doc_rag(chat:ChatInputModel, request:Request):
     # Extract results from the VectorDB
     results = search("dino_docs", chat.input, k=5)
 
@@ -58,14 +171,14 @@ async def dino_doc_rag(chat:ChatInputModel):
 
     """
 
-    # Invoke the chain with the prompt and return the response
-    return basic_chain.invoke(input={"input": prompt})
+    # Invoke the chain with the prompt and return the response (cancelled if the client leaves or time runs out)
+    return LLMResponseModel.from_ai_message(await run_cancellable(request, basic_chain.ainvoke(input={"input": prompt})))
 
 
 # Endpoint for querying the LLM about archeology plans (a bit more formal)
 # TODO: we never actually changed the tone of the prompt cuz I ran out of time
-@router.post("/plans-doc-rag")
-async def plans_doc_rag(chat:ChatInputModel):
+@router.post("/plans-doc-rag", response_model=LLMResponseModel, dependencies=[Depends(interactive_traffic), Depends(admission("rag"))])
+async def plans_doc_rag(chat:ChatInputModel, request:Request):
     # Extract results from the VectorDB
     results = search("plans_docs", chat.input, k=5)
 
@@ -82,5 +195,5 @@ async def plans_doc_rag(chat:ChatInputModel):
 
     """
 
-    # Invoke the chain with the prompt and return the response
-    return basic_chain.invoke(input={"input": prompt})
\ No newline at end of file
+    # Invoke the chain with the prompt and return the response (cancelled if the client leaves or time runs out)
+    return LLMResponseModel.from_ai_message(await run_cancellable(request, basic_chain.ainvoke(input={"input": prompt})))
\ No newline at end of file
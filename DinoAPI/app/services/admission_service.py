@@ -0,0 +1,328 @@
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import threading
+import time
+from contextlib import aclosing, closing
+from contextvars import ContextVar
+
+from fastapi import Request
+from langchain_ollama import ChatOllama
+
+from app.services.cancellation_service import check_cancelled
+from app.services.tracing_service import add_span
+
+# This service is the ADMISSION CONTROLLER that sits in front of our one local Ollama instance
+# Every LLM generation has to get a "slot" before it runs. That gives us:
+    # Bounded concurrency - only MAX_CONCURRENT_GENERATIONS hit Ollama at once
+    # Priority - waiting chat requests get the next free slot before RAG, and RAG before summarize
+    # Per-client quotas - one client can't fill the whole queue
+    # Load shedding - if the queue is so long that we'd miss the latency target, reject right away
+        # (a fast 503 with Retry-After beats a request that times out after 60 seconds)
+
+MAX_CONCURRENT_GENERATIONS = int(os.getenv("LLM_MAX_CONCURRENT", "2"))
+CLIENT_QUOTA = int(os.getenv("LLM_CLIENT_QUOTA", "4")) # Max queued + running generations per client
+LATENCY_TARGET_SECONDS = float(os.getenv("LLM_LATENCY_TARGET_SECONDS", "30"))
+
+# How often a BLOCKED (sync) waiter wakes up to check if its request was cancelled or ran out of time
+WAIT_CHECK_SECONDS = 0.25
+
+# Priority classes (lower number = served first)
+PRIORITY_CLASSES = {"chat": 0, "rag": 1, "summarize": 2}
+
+# The priority class + client of the request we're currently handling
+# A ContextVar is like a global variable, but each request (and the threads it uses) gets its own copy
+request_context: ContextVar[tuple[str, str]] = ContextVar("request_context", default=("summarize", "internal"))
+
+# Set while a generation holds a slot, so nested LLM calls in the same context don't ask for a second one
+_holding_slot: ContextVar[bool] = ContextVar("holding_slot", default=False)
+
+
+# Raised when a request gets turned away - main.py turns this into a 429/503 response with Retry-After
+class AdmissionRejected(Exception):
+
+    def __init__(self, status_code:int, detail:str, retry_after:int):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+
+    def __init__(self, max_concurrent:int, client_quota:int, latency_target:float):
+        self.max_concurrent = max_concurrent
+        self.client_quota = client_quota
+        self.latency_target = latency_target
+
+        self.lock = threading.Lock()
+        self.running = 0
+        self.waiting = [] # Heap of (priority, arrival order, waiter, client) - heapq keeps the best one first
+        self.arrivals = itertools.count()
+        self.client_counts: dict[str, int] = {}
+
+        # Moving average of how long a generation takes (we use it to estimate queue wait times)
+        self.average_seconds = 5.0
+
+        # Counters for the /metrics-style stats endpoint
+        self.stats = {"admitted": 0, "queued": 0, "rejected_quota": 0, "rejected_overload": 0}
+
+    # Estimate how long a new request with this priority would wait for a slot
+    def _estimated_wait(self, priority:int) -> float:
+        if self.running < self.max_concurrent and not self.waiting:
+            return 0.0
+        ahead = sum(1 for waiter in self.waiting if waiter[0] <= priority)
+        return (ahead + 1) / self.max_concurrent * self.average_seconds
+
+    # Check the quota/overload rules and take a slot if one is free
+    # Returns None when we got the slot right away, otherwise the heap entry we're waiting in
+    # waiter is a threading.Event (sync callers) or an asyncio future (async callers) - release() "wakes" it
+    def _enqueue(self, priority_class:str, client:str, waiter):
+        priority = PRIORITY_CLASSES.get(priority_class, len(PRIORITY_CLASSES))
+
+        with self.lock:
+            if self.client_counts.get(client, 0) >= self.client_quota:
+                self.stats["rejected_quota"] += 1
+                raise AdmissionRejected(429, "Too many concurrent LLM requests from this client",
+                                        math.ceil(self.average_seconds))
+
+            wait = self._estimated_wait(priority)
+            if wait > self.latency_target:
+                self.stats["rejected_overload"] += 1
+                raise AdmissionRejected(503, "The LLM is overloaded, try again later", math.ceil(wait))
+
+            self.client_counts[client] = self.client_counts.get(client, 0) + 1
+            self.stats["admitted"] += 1
+
+            # Free slot and nobody waiting? Go right ahead
+            if self.running < self.max_concurrent and not self.waiting:
+                self.running += 1
+                return None
+
+            # Otherwise wait in line - release() hands us the slot through our waiter
+            entry = (priority, next(self.arrivals), waiter, client)
+            heapq.heappush(self.waiting, entry)
+            self.stats["queued"] += 1
+            return entry
+
+    # Get a slot (blocking until one is free). Raises AdmissionRejected if we can't take the request
+    # Sync LLM calls (LangGraph's sync nodes, run_in_threadpool) end up here, in a worker thread
+    # So we don't just wait forever - every WAIT_CHECK_SECONDS we check whether the request got cancelled
+    # (deadline or disconnect), and if it did we leave the line instead of holding our spot until we're served
+    def acquire(self, priority_class:str, client:str):
+        event = threading.Event()
+        entry = self._enqueue(priority_class, client, event)
+        if entry is None:
+            return
+        try:
+            while not event.wait(WAIT_CHECK_SECONDS):
+                check_cancelled()
+        except BaseException:
+            self._leave_line(entry, client)
+            raise
+
+    # A waiter gave up (cancelled request) - take it out of the line, or give the slot back if it just got one
+    def _leave_line(self, entry:tuple, client:str):
+        with self.lock:
+            still_waiting = entry in self.waiting
+            if still_waiting:
+                self.waiting.remove(entry)
+                heapq.heapify(self.waiting)
+                self._forget_client(client)
+        if not still_waiting:
+            self.release(client)
+
+    # Async version - waits on an asyncio future instead of blocking a thread
+    # (parking a thread per waiter would run the event loop's thread pool dry, and then extra requests
+    # wait in the THREAD POOL's line, where we can't see them or put them in priority order)
+    async def acquire_async(self, priority_class:str, client:str):
+        future = asyncio.get_running_loop().create_future()
+        entry = self._enqueue(priority_class, client, future)
+        if entry is None:
+            return
+        try:
+            await future
+        except asyncio.CancelledError:
+            # The request went away while it was in line
+            with self.lock:
+                still_waiting = entry in self.waiting
+                if still_waiting:
+                    # Never got a slot - just leave the line
+                    self.waiting.remove(entry)
+                    heapq.heapify(self.waiting)
+                    self._forget_client(client)
+            # Got the slot just as we were cancelled - hand it right back
+            # (if the future itself got cancelled first, _grant_async hands it back instead)
+            if not still_waiting and not future.cancelled():
+                self.release(client)
+            raise
+
+    # Runs on the waiter's event loop: give it the slot, or pass the slot on if the waiter already left
+    def _grant_async(self, future, client:str):
+        if future.cancelled():
+            self.release(client)
+        else:
+            future.set_result(None)
+
+    def _forget_client(self, client:str):
+        self.client_counts[client] -= 1
+        if self.client_counts[client] == 0:
+            del self.client_counts[client]
+
+    # Give a slot back (and hand it straight to the best waiting request, if there is one)
+    # elapsed is how long the generation took (None if it never ran, so it doesn't skew the average)
+    def release(self, client:str, elapsed:float=None):
+        with self.lock:
+            if elapsed is not None:
+                self.average_seconds = 0.8 * self.average_seconds + 0.2 * elapsed
+            self._forget_client(client)
+
+            if not self.waiting:
+                self.running -= 1
+                return
+            # The slot passes over, so running stays the same
+            _, _, waiter, waiter_client = heapq.heappop(self.waiting)
+
+        if isinstance(waiter, threading.Event):
+            waiter.set()
+        else:
+            waiter.get_loop().call_soon_threadsafe(self._grant_async, waiter, waiter_client)
+
+    # Current state, for the stats endpoint
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "running": self.running,
+                "waiting": len(self.waiting),
+                "average_generation_seconds": round(self.average_seconds, 3),
+                **self.stats
+            }
+
+
+# One controller shared by every LLM in the app
+controller = AdmissionController(MAX_CONCURRENT_GENERATIONS, CLIENT_QUOTA, LATENCY_TARGET_SECONDS)
+
+
+# FastAPI dependency factory - tags a route with its priority class, e.g. Depends(admission("rag"))
+# The client is the X-Client-Id header if there is one, otherwise the caller's IP address
+def admission(priority_class:str):
+    async def set_request_context(request:Request):
+        client = request.headers.get("X-Client-Id") or (request.client.host if request.client else "unknown")
+        request_context.set((priority_class, client))
+    return set_request_context
+
+
+# ChatOllama, but every generation goes through the admission controller first
+# The services use this instead of ChatOllama, so there's no way to sneak past the controller
+class AdmittedChatOllama(ChatOllama):
+
+    def _admit(self):
+        if _holding_slot.get():
+            return None
+        priority_class, client = request_context.get()
+        controller.acquire(priority_class, client)
+        _holding_slot.set(True)
+        return client, time.monotonic()
+
+    def _leave(self, ticket):
+        if ticket is not None:
+            _holding_slot.set(False)
+            controller.release(ticket[0], time.monotonic() - ticket[1])
+
+    # Every generation also shows up in the request's trace, with its prompt/completion token counts
+    def _start_span(self):
+        return add_span("llm", "llm", model=self.model)
+
+    def _end_span(self, llm_span, message):
+        if llm_span is None:
+            return
+        llm_span.end = time.perf_counter()
+        usage = getattr(message, "usage_metadata", None)
+        if usage:
+            llm_span.attributes["prompt_tokens"] = usage["input_tokens"]
+            llm_span.attributes["completion_tokens"] = usage["output_tokens"]
+
+    def _generate(self, *args, **kwargs):
+        llm_span = self._start_span()
+        ticket = self._admit()
+        result = None
+        try:
+            result = super()._generate(*args, **kwargs)
+            return result
+        finally:
+            self._leave(ticket)
+            self._end_span(llm_span, result.generations[0].message if result else None)
+
+    def _stream(self, *args, **kwargs):
+        llm_span = self._start_span()
+        ticket = self._admit()
+        last_chunk = None
+        try:
+            with closing(super()._stream(*args, **kwargs)) as chunks:
+                for last_chunk in chunks:
+                    yield last_chunk
+        finally:
+            self._leave(ticket)
+            self._end_span(llm_span, last_chunk.message if last_chunk else None)
+
+    # The async versions wait for a slot on the event loop itself (no thread gets parked while waiting)
+    async def _aadmit(self):
+        if _holding_slot.get():
+            return None
+        priority_class, client = request_context.get()
+        await controller.acquire_async(priority_class, client)
+        _holding_slot.set(True)
+        return client, time.monotonic()
+
+    async def _agenerate(self, *args, **kwargs):
+        llm_span = self._start_span()
+        ticket = await self._aadmit()
+        result = None
+        try:
+            result = await super()._agenerate(*args, **kwargs)
+            return result
+        finally:
+            self._leave(ticket)
+            self._end_span(llm_span, result.generations[0].message if result else None)
+
+    async def _astream(self, *args, **kwargs):
+        llm_span = self._start_span()
+        ticket = await self._aadmit()
+        last_chunk = None
+        try:
+            # aclosing() so a cancelled stream closes all the way down to the Ollama connection right away
+            async with aclosing(super()._astream(*args, **kwargs)) as chunks:
+                async for last_chunk in chunks:
+                    yield last_chunk
+        finally:
+            self._leave(ticket)
+            self._end_span(llm_span, last_chunk.message if last_chunk else None)
+
+    # Every generation (streamed or not) reads Ollama's response through these two streams
+    # If the request gets cancelled (deadline or disconnect), we stop reading and close the stream,
+    # which closes the connection and makes Ollama stop generating (see cancellation_service)
+    # We close Ollama's stream OURSELVES - left to the garbage collector, the connection can stay open
+    # (and Ollama keeps generating) long after the request is gone
+    def _create_chat_stream(self, messages, stop=None, **kwargs):
+        check_cancelled() # Don't even start if the request was cancelled while it waited for a slot
+        chat_params = self._chat_params(messages, stop, **kwargs)
+        if not chat_params["stream"]:
+            yield self._client.chat(**chat_params)
+            return
+        with closing(self._client.chat(**chat_params)) as parts:
+            for part in parts:
+                check_cancelled()
+                yield part
+
+    async def _acreate_chat_stream(self, messages, stop=None, **kwargs):
+        check_cancelled()
+        chat_params = self._chat_params(messages, stop, **kwargs)
+        if not chat_params["stream"]:
+            yield await self._async_client.chat(**chat_params)
+            return
+        async with aclosing(await self._async_client.chat(**chat_params)) as parts:
+            async for part in parts:
+                check_cancelled()
+                yield part
@@ -1,16 +1,22 @@
+import contextvars
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import TypedDict, Any
 
 from langchain_core.messages import SystemMessage, HumanMessage
 from langchain_core.tools import tool
-from langchain_ollama import ChatOllama
 from langgraph.graph import StateGraph
 
-from app.services.vectordb_service import search
+from app.services.model_cascade_service import cascade_model
+from app.services.tracing_service import traced_node
+from app.services.vectordb_service import search, EMBEDDING, precomputed_query_vectors
 
-llm = ChatOllama(
-    model="llama3.2:3b",
-    temperature=0.5
-)
+# One model per node from the cascade (see model_cascade_service)
+# The router's yes/no tool decision goes to the small model, and only escalates if its tool call makes no sense
+router_llm = cascade_model("agentic.route")
+answer_llm = cascade_model("agentic.answer_with_docs")
+chat_llm = cascade_model("agentic.general_chat")
 
 # This is the State object for our Graph
 # Like in React, State holds data that we want to keep track of
@@ -56,7 +62,71 @@ TOOLS = [search_dino_docs, search_plans_docs]
 TOOL_MAP = {tool.name: tool for tool in TOOLS}
 
 # Get a version of the LLM that's aware of the tools (this is the LLM we'll invoke)
-llm_with_tools = llm.bind_tools(TOOLS)
+llm_with_tools = router_llm.bind_tools(TOOLS)
+
+# =====================(SPECULATIVE RETRIEVAL)======================
+
+# With SPECULATIVE retrieval on, we start BOTH searches at the same time as the router LLM
+# The searches are way faster than the LLM, so by the time it picks a tool, the results are already waiting
+# We keep the one the router picks and throw the other away (that's the "waste")
+SPECULATIVE_RETRIEVAL = os.getenv("AGENTIC_SPECULATIVE_RETRIEVAL", "true").lower() == "true"
+
+# Small thread pool just for the speculative searches
+speculation_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="speculative-search")
+# ...and a separate one for embedding their query. The searches WAIT on the embedding, so if it shared their pool,
+# a full pool of waiting searches could leave the embedding with no thread to run on (deadlock)
+speculation_embedding_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="speculative-embed")
+
+# Hit/waste counters, reported at /debug/speculation
+speculation_stats = {"routed": 0, "hits": 0, "searches_started": 0, "searches_wasted": 0}
+_stats_lock = threading.Lock()
+
+# Runs in the speculation pool: wait for the shared query vector, then search with it
+# If the embedding failed, the search just embeds the query itself (so it fails or succeeds on its own)
+def _speculative_search(tool, query:str, vector_future):
+    try:
+        precomputed_query_vectors.set({query: vector_future.result()})
+    except Exception:
+        pass
+    return tool.invoke({"query": query})
+
+# Start every tool's search in the background. Returns {tool name: future}
+def start_speculative_searches(query:str) -> dict:
+
+    # The bulk query runner may have embedded the query already - then every search just uses that vector
+    precomputed = precomputed_query_vectors.get() or {}
+    if query in precomputed:
+        return {
+            name: speculation_pool.submit(contextvars.copy_context().run, tool.invoke, {"query": query})
+            for name, tool in TOOL_MAP.items()
+        }
+
+    # Otherwise embed the query ONCE in the background and hand the vector to every search
+    # (so the router LLM call starts right away, and the searches don't each embed the same query)
+    # copy_context() so the embedding and the searches still show up in this request's trace
+    vector_future = speculation_embedding_pool.submit(contextvars.copy_context().run, EMBEDDING.embed_query, query)
+    return {
+        name: speculation_pool.submit(contextvars.copy_context().run, _speculative_search, tool, query, vector_future)
+        for name, tool in TOOL_MAP.items()
+    }
+
+# Record how the speculation went (chosen_tool is None when the router picked general chat)
+def record_speculation(chosen_tool:str | None):
+    with _stats_lock:
+        speculation_stats["routed"] += 1
+        speculation_stats["searches_started"] += len(TOOL_MAP)
+        speculation_stats["searches_wasted"] += len(TOOL_MAP) - (1 if chosen_tool in TOOL_MAP else 0)
+        if chosen_tool in TOOL_MAP:
+            speculation_stats["hits"] += 1
+
+# Stats plus the rates we actually care about
+def get_speculation_stats() -> dict:
+    with _stats_lock:
+        stats = dict(speculation_stats)
+    stats["enabled"] = SPECULATIVE_RETRIEVAL
+    stats["hit_rate"] = stats["hits"] / stats["routed"] if stats["routed"] else 0.0
+    stats["waste_rate"] = stats["searches_wasted"] / stats["searches_started"] if stats["searches_started"] else 0.0
+    return stats
 
 # NODES (These still exist! But they won't be part of the agent's decision options)
 
@@ -85,18 +155,29 @@ def agentic_router_node(state:GraphState) -> GraphState:
         HumanMessage(content=query)
     ]
 
+    # Kick off the speculative searches BEFORE the LLM call, so they run while it's thinking
+    speculative = start_speculative_searches(query) if SPECULATIVE_RETRIEVAL else {}
+
     # Invoke the LLM with tools using the prompt
     # The LLM will decide whether to use a tool, and which tool to use
     agentic_response = llm_with_tools.invoke(messages)
 
     # If there was no tool call, route will equal "chat" for general chats
     if agentic_response.tool_calls == []:
+        if speculative:
+            record_speculation(None)
         return {"route":"chat"}
 
     # If there WAS a tool call, invoke the tool, and store results in the appropriate route
     tool_call = agentic_response.tool_calls[0] # Get the first tool call (there should only be one)
     tool_name = tool_call["name"] # Extracting the name of the tool that was called
-    results = TOOL_MAP[tool_name].invoke({"query":query})
+
+    # With speculation, the results are already there (or almost) - otherwise run the tool now
+    if tool_name in speculative:
+        record_speculation(tool_name)
+        results = speculative[tool_name].result()
+    else:
+        results = TOOL_MAP[tool_name].invoke({"query":query})
 
     # Automatically set the route to the answer_with_context node and set the docs after the tool is done
     return {
@@ -129,7 +210,7 @@ def answer_with_docs(state:GraphState) -> GraphState:
     )
 
     # Invoke the LLM! And save the answer in state
-    response = llm.invoke(prompt)
+    response = answer_llm.invoke(prompt)
     return {"answer":response.text}
 
 # Here's the general chat node that we fall back to if the query isn't related to vector data
@@ -150,7 +231,7 @@ def general_chat_node(state:GraphState) -> GraphState:
     )
 
     # Return the invocation and store it in State
-    response = llm.invoke(prompt)
+    response = chat_llm.invoke(prompt)
     return {"answer":response.text}
 
 
@@ -161,10 +242,10 @@ def build_agentic_graph():
     # First, define the graph builder using the State Graph
     build = StateGraph(GraphState)
 
-    # Register each node
-    build.add_node("route", agentic_router_node)
-    build.add_node("answer_with_docs", answer_with_docs)
-    build.add_node("general_chat", general_chat_node)
+    # Register each node (traced_node makes each node show up as a span in the request's trace)
+    build.add_node("route", traced_node("route", agentic_router_node))
+    build.add_node("answer_with_docs", traced_node("answer_with_docs", answer_with_docs))
+    build.add_node("general_chat", traced_node("general_chat", general_chat_node))
 
     # Set the node that starts the graph (router node in this case)
     build.set_entry_point("route")
@@ -179,16 +260,16 @@ def build_agentic_graph():
 
         # Map that connects the possible "route" values to the appropriate note
         # This is route : node
-            # ex: if the route is "chat", invoke the "general_chat_node
+            # ex: if the route is "chat", invoke the "general_chat" node
         {
-            "chat":"general_chat_node",
+            "chat":"general_chat",
             "answer_with_docs":"answer_with_docs"
         }
     )
 
     # Define potential terminal node (stopping points) for the graph
     build.set_finish_point("answer_with_docs")
-    build.set_finish_point("general_chat_node")
+    build.set_finish_point("general_chat")
 
     # Return the built graph!
     return build.compile()
@@ -0,0 +1,186 @@
+import argparse
+import contextvars
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from app.services.admission_service import AdmissionRejected, CLIENT_QUOTA, request_context
+from app.services.agentic_langgraph_service import agentic_graph
+from app.services.langgraph_service import langgraph, route_node
+from app.services.tracing_service import Span, current_span
+from app.services.vectordb_service import EMBEDDING, precomputed_query_vectors
+
+# This service runs LOTS of queries through our LangGraph graphs OFFLINE (for evaluations and pre-generating answers)
+# Instead of hitting /langgraph/* over HTTP one request at a time:
+    # Queries come from a JSONL file - one {"query": "...", "id": "..."} per line ("id" is optional)
+    # Queries get embedded in BATCHES up front (in parallel over the embedding connection pool, not one by one mid-graph)
+    # Up to "concurrency" queries run through the graph at the same time
+    # Each result gets written to the output JSONL the moment it finishes
+    # The output file doubles as the CHECKPOINT - run it again and it skips everything that already finished
+        # (finished for the SAME graph - answers from the other graph don't count, even if the ids match)
+
+GRAPHS = {"langgraph": langgraph, "agentic": agentic_graph}
+
+# Bulk work is the lowest priority LLM traffic - it runs as "summarize" so interactive requests go first
+BULK_CLIENT = "bulk"
+
+# How many times a query retries when the admission controller turns it away (it waits Retry-After between tries)
+MAX_ADMISSION_RETRIES = 5
+
+
+# Read the queries, numbering them by line if they don't have their own ID
+def read_queries(input_path:str) -> list[dict]:
+    queries = []
+    with open(input_path, encoding="utf-8") as file:
+        for line_number, line in enumerate(file, start=1):
+            if line.strip():
+                query = json.loads(line)
+                query.setdefault("id", line_number)
+                queries.append(query)
+    return queries
+
+
+# IDs that already have an answer from this graph in the output file (failed ones run again)
+# Every result line records its graph, so a file shared by both graphs keeps their checkpoints apart
+# A half-written last line (from getting interrupted mid-write) just gets skipped
+def finished_ids(output_path:str, graph_name:str) -> set:
+    finished = set()
+    if not os.path.exists(output_path):
+        return finished
+    with open(output_path, encoding="utf-8") as file:
+        for line in file:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if "error" not in result and result.get("graph") == graph_name:
+                finished.add(result["id"])
+    return finished
+
+
+# Cut off a half-written last line, so the next result doesn't get glued onto the end of it
+def trim_partial_line(output_path:str):
+    if not os.path.exists(output_path):
+        return
+    with open(output_path, "rb+") as file:
+        content = file.read()
+        if content and not content.endswith(b"\n"):
+            file.truncate(content.rfind(b"\n") + 1)
+
+
+# Queries that will actually search the vector DB (so they're worth embedding ahead of time)
+# The agentic router searches speculatively on every query, the keyword graph only does for dino/plans routes
+def needs_embedding(graph_name:str, query:str) -> bool:
+    return graph_name == "agentic" or route_node({"query": query})["route"] != "chat"
+
+
+# Run one query through the graph (in a worker thread)
+def run_query(graph_name:str, query:dict) -> dict:
+
+    # A root span (that never gets stored) so we can read how long each node took
+    root = Span(graph_name, "request", {})
+    current_span.set(root)
+    request_context.set(("summarize", BULK_CLIENT))
+
+    for attempt in range(MAX_ADMISSION_RETRIES + 1):
+        try:
+            state = GRAPHS[graph_name].invoke({"query": query["query"]})
+            break
+        except AdmissionRejected as e:
+            if attempt == MAX_ADMISSION_RETRIES:
+                raise
+            time.sleep(e.retry_after)
+    root.end = time.perf_counter()
+
+    return {
+        "id": query["id"],
+        "query": query["query"],
+        "graph": graph_name,
+        "route": state.get("route"),
+        "answer": state.get("answer"),
+        "duration_ms": round(root.duration_ms, 3),
+        "node_ms": {child.name: round(child.duration_ms, 3) for child in root.children if child.kind == "node"}
+    }
+
+
+# The Python API - returns a summary of the run
+def run_bulk(input_path:str, output_path:str, graph_name:str="agentic", concurrency:int=CLIENT_QUOTA,
+             batch_size:int=32) -> dict:
+
+    if graph_name not in GRAPHS:
+        raise ValueError(f"Graph must be one of {list(GRAPHS)}")
+
+    trim_partial_line(output_path)
+    done = finished_ids(output_path, graph_name)
+    queries = [query for query in read_queries(input_path) if query["id"] not in done]
+    summary = {"skipped": len(done), "succeeded": 0, "failed": 0}
+    write_lock = threading.Lock()
+    start = time.perf_counter()
+
+    with open(output_path, "a", encoding="utf-8") as output, \
+            ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="bulk-query") as executor:
+
+        def write_result(future, query):
+            try:
+                result = future.result()
+                summary["succeeded"] += 1
+            except Exception as e:
+                result = {"id": query["id"], "query": query["query"], "graph": graph_name, "error": repr(e)}
+                summary["failed"] += 1
+            with write_lock:
+                output.write(json.dumps(result) + "\n")
+                output.flush() # Flushed right away, so an interruption never loses a finished answer
+
+        in_flight = {}
+        try:
+            for batch_start in range(0, len(queries), batch_size):
+                batch = queries[batch_start:batch_start + batch_size]
+
+                # Embed the whole batch at once (the workers keep going on the last batch meanwhile)
+                # (still one request per text - see the NOTE in vectordb_service.search_many)
+                texts = list({query["query"] for query in batch if needs_embedding(graph_name, query["query"])})
+                vectors = dict(zip(texts, EMBEDDING.embed_documents(texts))) if texts else {}
+
+                for query in batch:
+                    # Don't get more than "concurrency" queries ahead of the workers
+                    while len(in_flight) >= concurrency:
+                        finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                        for future in finished:
+                            write_result(future, in_flight.pop(future))
+
+                    # Each query runs in its own context with just its own precomputed vector
+                    context = contextvars.copy_context()
+                    if query["query"] in vectors:
+                        context.run(precomputed_query_vectors.set, {query["query"]: vectors[query["query"]]})
+                    in_flight[executor.submit(context.run, run_query, graph_name, query)] = query
+
+            finished, _ = wait(in_flight)
+            for future in finished:
+                write_result(future, in_flight.pop(future))
+        except KeyboardInterrupt:
+            # Stop handing out queries - what's already written is the checkpoint for next time
+            executor.shutdown(wait=True, cancel_futures=True)
+            for future, query in in_flight.items():
+                if future.done() and not future.cancelled():
+                    write_result(future, query)
+            raise
+
+    summary["seconds"] = round(time.perf_counter() - start, 3)
+    return summary
+
+
+# Command line usage (run from the DinoAPI folder):
+    # python -m app.services.bulk_query_service questions.jsonl answers.jsonl --graph agentic --concurrency 4
+# Run the same command again after an interruption to pick up where it left off
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a JSONL file of queries through a LangGraph graph")
+    parser.add_argument("input")
+    parser.add_argument("output")
+    parser.add_argument("--graph", default="agentic", choices=list(GRAPHS))
+    parser.add_argument("--concurrency", type=int, default=CLIENT_QUOTA)
+    parser.add_argument("--batch-size", type=int, default=32, help="How many queries to embed at once")
+    args = parser.parse_args()
+
+    print(run_bulk(args.input, args.output, args.graph, args.concurrency, args.batch_size))
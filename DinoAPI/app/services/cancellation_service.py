@@ -0,0 +1,191 @@
+import asyncio
+import os
+import threading
+import time
+from contextvars import ContextVar
+
+from fastapi import Request
+
+# This service CANCELS LLM work that nobody is waiting for anymore
+# A request gets cancelled when:
+    # Its DEADLINE passes - from the X-Request-Timeout header (seconds), or the route's default
+    # The client DISCONNECTS - closed the tab, hit stop, timed out on their end...
+# Cancelling means:
+    # The request's task gets cancelled, so a chain/graph doesn't start its next step or node
+    # Any Ollama stream that's running gets closed, which makes Ollama stop generating
+        # (AdmittedChatOllama checks check_cancelled() before the call and between every streamed chunk)
+# Every cancellation gets counted, see /debug/cancellations
+
+# Default deadline (seconds) for routes that don't have their own
+DEFAULT_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "120"))
+
+# The longest deadline a client is allowed to ask for with the header
+MAX_DEADLINE_SECONDS = float(os.getenv("REQUEST_MAX_DEADLINE_SECONDS", "600"))
+
+# Per-route default deadlines (two LLM calls or a whole graph get a bit more time than one LLM call)
+route_deadlines: dict[str, float] = {
+    "/langchain/chat": 60,
+    "/langchain/summarize": 120,
+    "/langchain/refined-chat": 90,
+    "/langchain/memory-chat": 60,
+    "/langchain/dino-recs": 90,
+    "/langgraph/langgraph": 120,
+    "/langgraph/agentic-langgraph": 120,
+    "/vector/dino-doc-rag": 90,
+    "/vector/plans-doc-rag": 90,
+    "/users/rag": 90
+}
+
+# Raised inside a cancelled request's work (LLM calls, graph nodes) so it stops where it is
+class RequestCancelled(Exception):
+
+    # 504 for a missed deadline. 499 ("client closed request") for disconnects - nobody will see it anyway
+    STATUS_CODES = {"deadline": 504, "disconnect": 499}
+
+    def __init__(self, reason:str):
+        super().__init__(f"Request cancelled ({reason})")
+        self.reason = reason
+        self.status_code = self.STATUS_CODES[reason]
+
+
+# One request's deadline + whether it's been cancelled
+# LLM calls run in worker threads too, so "cancelled" is a threading.Event they can all see
+class CancelScope:
+
+    def __init__(self, deadline:float):
+        self.deadline = deadline # time.monotonic() value
+        self.reason = None
+        self.cancelled = threading.Event()
+
+    def cancel(self, reason:str):
+        if not self.cancelled.is_set():
+            self.reason = reason
+            self.cancelled.set()
+
+    def check(self):
+        if not self.cancelled.is_set() and time.monotonic() >= self.deadline:
+            self.cancel("deadline")
+        if self.cancelled.is_set():
+            raise RequestCancelled(self.reason)
+
+
+# The current request's scope (None outside of a cancellable request, so check_cancelled() does nothing)
+current_scope: ContextVar[CancelScope | None] = ContextVar("current_scope", default=None)
+
+# Cancellation counters by reason and by route
+cancellation_stats = {"deadline": 0, "disconnect": 0, "by_route": {}}
+_stats_lock = threading.Lock()
+
+
+def record_cancellation(path:str, reason:str):
+    with _stats_lock:
+        cancellation_stats[reason] += 1
+        by_route = cancellation_stats["by_route"].setdefault(path, {"deadline": 0, "disconnect": 0})
+        by_route[reason] += 1
+
+
+def get_cancellation_stats() -> dict:
+    with _stats_lock:
+        return {
+            "deadline": cancellation_stats["deadline"],
+            "disconnect": cancellation_stats["disconnect"],
+            "by_route": {path: dict(counts) for path, counts in cancellation_stats["by_route"].items()}
+        }
+
+
+# Called from the LLM calls and graph nodes - raises RequestCancelled if the current request was cancelled
+def check_cancelled():
+    scope = current_scope.get()
+    if scope is not None:
+        scope.check()
+
+
+# Build a scope for a request: the X-Request-Timeout header wins, otherwise the route's default
+def _scope_for(request:Request) -> CancelScope:
+    seconds = route_deadlines.get(request.url.path, DEFAULT_DEADLINE_SECONDS)
+    header = request.headers.get("X-Request-Timeout")
+    if header:
+        try:
+            seconds = min(max(float(header), 0.0), MAX_DEADLINE_SECONDS)
+        except ValueError:
+            pass # Bad header - just use the route's default
+    return CancelScope(time.monotonic() + seconds)
+
+
+# Returns once the client disconnects (the server sends an "http.disconnect" message when it does)
+# The request body has already been read by the time the endpoint runs, so that's the only message left
+async def _wait_for_disconnect(request:Request):
+    while (await request.receive())["type"] != "http.disconnect":
+        pass
+
+
+# Run a chain/graph call (any awaitable) so it gets cancelled if the deadline passes or the client leaves
+# ex: result = await run_cancellable(request, agentic_graph.ainvoke({"query": chat.input}))
+async def run_cancellable(request:Request, awaitable):
+    scope = _scope_for(request)
+    token = current_scope.set(scope)
+
+    # The work task copies our context, so everything it runs (even in worker threads) can see the scope
+    work = asyncio.ensure_future(awaitable)
+    disconnected = asyncio.ensure_future(_wait_for_disconnect(request))
+    try:
+        # Wait for whichever comes first: the work finishing, the client leaving, or the deadline
+        done, _ = await asyncio.wait(
+            {work, disconnected},
+            timeout=max(0.0, scope.deadline - time.monotonic()),
+            return_when=asyncio.FIRST_COMPLETED
+        )
+
+        if work in done:
+            try:
+                return work.result()
+            except RequestCancelled as e:
+                # An LLM call or node noticed the deadline before we did
+                record_cancellation(request.url.path, e.reason)
+                raise
+
+        scope.cancel("disconnect" if disconnected in done else "deadline")
+        work.cancel()
+        # Nobody awaits the task after this, so grab its exception (if any) to keep asyncio from warning about it
+        work.add_done_callback(lambda cancelled: cancelled.cancelled() or cancelled.exception())
+        record_cancellation(request.url.path, scope.reason)
+        raise RequestCancelled(scope.reason)
+    finally:
+        disconnected.cancel()
+        current_scope.reset(token)
+
+
+# Same idea for streaming responses - wrap the async generator of events before handing it to ndjson_response
+# Starlette stops the stream when the client disconnects, so that part is detected for us
+# A missed deadline can't change the status code anymore (it was sent with the first event),
+# so the stream ends with a "cancelled" event instead
+async def stream_cancellable(request:Request, events):
+    scope = _scope_for(request)
+    # No reset needed - the stream runs in its own task, so the scope goes away with it
+    current_scope.set(scope)
+
+    # Each step of the stream runs in its own task, and we cancel that task ourselves (ONCE)
+    # Starlette's cancellation keeps re-cancelling everything in its task, which would interrupt
+    # the Ollama stream halfway through closing its connection (so Ollama would keep generating)
+    step = None
+    try:
+        while True:
+            step = asyncio.ensure_future(anext(events))
+            try:
+                event = await asyncio.shield(step)
+            except StopAsyncIteration:
+                return
+            scope.check()
+            yield event
+    except RequestCancelled as e:
+        record_cancellation(request.url.path, e.reason)
+        yield {"stage": "cancelled", "reason": e.reason}
+    except (asyncio.CancelledError, GeneratorExit):
+        # The stream was closed early - the client went away
+        scope.cancel("disconnect")
+        record_cancellation(request.url.path, "disconnect")
+        if not step.done():
+            step.cancel() # Stops the step mid-stream, which closes the Ollama stream on the way out
+        else:
+            asyncio.ensure_future(events.aclose()) # Between steps - just close the stream
+        raise
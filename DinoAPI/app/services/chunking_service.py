@@ -0,0 +1,149 @@
+import multiprocessing
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from pydantic import BaseModel, Field, model_validator
+
+# This service does all of our CHUNKING (splitting text into pieces before we embed it)
+# Compared to the old "new splitter every call, 500 characters" approach:
+    # Chunk sizes are measured in TOKENS (what the embedding model actually sees), not characters
+    # Chunks break on paragraph, then line, then SENTENCE boundaries before falling back to words
+    # Every collection can have its own chunk size and overlap (a "chunk profile")
+        # Profiles get saved in the collection's metadata (see vectordb_service.get_chunk_profile/set_chunk_profile)
+    # Splitters get built once and reused
+    # Really big documents get split across a pool of processes
+
+# Rough token counter - words and punctuation marks each count as one token
+# It's not the embedding model's exact tokenizer, but it's close enough to size chunks with (and fast)
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+# Split on paragraphs first, then lines, then sentences, then words
+SEPARATORS = ["\n\n", "\n", ". ", "! ", "? ", "; ", " "]
+
+# Documents bigger than this (in characters) get fanned out across the process pool
+PARALLEL_THRESHOLD_CHARS = 200_000
+CHUNKING_PROCESSES = int(os.getenv("CHUNKING_PROCESSES", str(max(1, (os.cpu_count() or 2) - 1))))
+
+
+# How a collection's text gets chunked
+class ChunkProfile(BaseModel):
+    chunk_tokens: int = Field(gt=0)
+    overlap_tokens: int = Field(ge=0)
+
+    @model_validator(mode="after")
+    def overlap_smaller_than_chunk(self):
+        if self.overlap_tokens >= self.chunk_tokens:
+            raise ValueError("overlap_tokens must be smaller than chunk_tokens")
+        return self
+
+    # Saved with the rest of the collection's metadata (so it survives restarts and every worker sees it)
+    def to_metadata(self) -> dict:
+        return self.model_dump()
+
+    # The profile saved in a collection's metadata, or None if it never got one
+    @classmethod
+    def from_metadata(cls, metadata:dict | None):
+        metadata = metadata or {}
+        if "chunk_tokens" not in metadata:
+            return None
+        return cls(chunk_tokens=metadata["chunk_tokens"], overlap_tokens=metadata["overlap_tokens"])
+
+
+# Used for any collection that doesn't have its own profile
+# (~120 tokens is about the same as the old 500 character chunks, with a lot less overlap)
+DEFAULT_PROFILE = ChunkProfile(chunk_tokens=120, overlap_tokens=15)
+
+# Built in profiles for collections that haven't saved their own - short personal notes vs. longer planning docs
+default_chunk_profiles: dict[str, ChunkProfile] = {
+    "dino_docs": ChunkProfile(chunk_tokens=80, overlap_tokens=10),
+    "plans_docs": ChunkProfile(chunk_tokens=160, overlap_tokens=20)
+}
+
+
+def count_tokens(text:str) -> int:
+    return len(TOKEN_PATTERN.findall(text))
+
+
+def default_chunk_profile(collection:str) -> ChunkProfile:
+    return default_chunk_profiles.get(collection, DEFAULT_PROFILE)
+
+
+# Build a splitter for a chunk size/overlap - lru_cache means each one only gets built once
+# (This also works inside the pool processes, each one keeps its own cache)
+@lru_cache(maxsize=32)
+def get_splitter(chunk_tokens:int, overlap_tokens:int) -> RecursiveCharacterTextSplitter:
+    return RecursiveCharacterTextSplitter(
+        chunk_size=chunk_tokens,
+        chunk_overlap=overlap_tokens,
+        length_function=count_tokens, # Measure chunks in tokens instead of characters
+        separators=SEPARATORS,
+        keep_separator="end" # Keep the period with its sentence, instead of starting the next chunk with it
+    )
+
+
+# Runs in a pool process - has to be a top level function so it can be sent to the other process
+def _split_section(args:tuple[str, int, int]) -> list[str]:
+    section, chunk_tokens, overlap_tokens = args
+    return get_splitter(chunk_tokens, overlap_tokens).split_text(section)
+
+
+# Cut a huge document into about "count" sections, only ever cutting between paragraphs
+def _sections(text:str, count:int) -> list[str]:
+    paragraphs = text.split("\n\n")
+    target = len(text) // count + 1
+    sections, current, size = [], [], 0
+    for paragraph in paragraphs:
+        current.append(paragraph)
+        size += len(paragraph) + 2
+        if size >= target:
+            sections.append("\n\n".join(current))
+            current, size = [], 0
+    if current:
+        sections.append("\n\n".join(current))
+    return sections
+
+
+# The last "tokens" tokens of a section (cut at a token start, so no word gets split in half)
+def _tail(section:str, tokens:int) -> str:
+    starts = [match.start() for match in TOKEN_PATTERN.finditer(section)]
+    return section[starts[-tokens]:] if len(starts) > tokens else section
+
+
+# The pool processes get SPAWNED (fresh interpreters), not forked - the server is full of threads
+# (ingest workers, Ollama connection pools, Chroma) and forking a threaded process can copy a lock
+# that some other thread was holding, which then deadlocks the child
+# The lock makes sure two threads splitting big documents at the same time don't both create a pool
+_pool: ProcessPoolExecutor | None = None
+_pool_lock = threading.Lock()
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=CHUNKING_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+# Split text into chunks using a chunk profile (vectordb_service passes in the collection's profile)
+def split_text(text:str, profile:ChunkProfile) -> list[str]:
+
+    # Small documents (almost all of them) just get split right here
+    if len(text) < PARALLEL_THRESHOLD_CHARS or CHUNKING_PROCESSES < 2:
+        return get_splitter(profile.chunk_tokens, profile.overlap_tokens).split_text(text)
+
+    # Big documents get cut into sections at paragraph breaks and split in parallel
+    # pool.map keeps the sections in order, so the chunks come back in document order
+    sections = _sections(text, CHUNKING_PROCESSES * 4)
+
+    # Each section gets split on its own, so nothing would overlap across a cut - to keep the overlap there too,
+    # every section starts with the last overlap_tokens tokens of the section before it
+    sections = sections[:1] + [
+        _tail(previous, profile.overlap_tokens) + "\n\n" + section if profile.overlap_tokens else section
+        for previous, section in zip(sections, sections[1:])
+    ]
+    jobs = [(section, profile.chunk_tokens, profile.overlap_tokens) for section in sections]
+    return [chunk for chunks in _get_pool().map(_split_section, jobs) for chunk in chunks]
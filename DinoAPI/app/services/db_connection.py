@@ -3,6 +3,8 @@ from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
+from app.services.tracing_service import instrument_engine
+
 DB_URL = "sqlite:///./app.db" # DB will live in the app directory
 
 # Create the engine that will connect to the DB
@@ -11,6 +13,9 @@ engine = create_engine(
     connect_args={"check_same_thread":False} # allows concurrent requests (DB requests at the same time)
 )
 
+# Every SQL statement run during a request shows up in that request's trace
+instrument_engine(engine)
+
 # Define the Session which will let us interact with the DB
 LocalSession = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 """
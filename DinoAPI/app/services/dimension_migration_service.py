@@ -0,0 +1,90 @@
+import argparse
+
+from app.services import vectordb_service
+from app.services.vectordb_service import (
+    EMBEDDING_FULL_DIMENSION, MATRYOSHKA_DIMENSIONS, get_vector_store, get_embedding_dimension, get_index_settings,
+    truncate_vectors, after_ingest, get_chunk_profile, set_chunk_profile
+)
+
+# This service MIGRATES an existing collection to a smaller (Matryoshka truncated) embedding dimension
+# Chroma can't change a collection's dimension in place, so we:
+    # 1. Read every vector out of the old collection
+    # 2. Truncate + re-normalize them (no re-embedding needed - the full vectors already have what we need!)
+    # 3. Write them to a new collection that's marked with the new dimension
+    # 4. Optionally (replace=True) delete the old collection and give the new one its name
+
+BATCH_SIZE = 5000
+
+
+def migrate_collection(collection:str, dimension:int, target:str=None, replace:bool=False) -> dict:
+
+    if dimension not in MATRYOSHKA_DIMENSIONS:
+        raise ValueError(f"Dimension must be one of {MATRYOSHKA_DIMENSIONS}")
+
+    source = get_vector_store(collection)
+    source_dimension = get_embedding_dimension(source)
+    # Truncation starts with a layer norm over ALL 768 dims, so an already truncated collection can't be shrunk again
+    if source_dimension != EMBEDDING_FULL_DIMENSION:
+        raise ValueError(f"Collection '{collection}' is already truncated to {source_dimension} dimensions "
+                         f"(only full {EMBEDDING_FULL_DIMENSION} dimension collections can be migrated)")
+
+    target = target or f"{collection}_{dimension}d"
+    # The new collection gets the same HNSW index settings as the old one
+    target_store = get_vector_store(target, dimension, get_index_settings(source))
+    if get_embedding_dimension(target_store) != dimension or target_store._collection.count() > 0:
+        raise ValueError(f"Target collection '{target}' already exists")
+    # ...and the same chunk profile (it lives in the collection's metadata, so it doesn't copy over on its own)
+    set_chunk_profile(target, get_chunk_profile(collection))
+
+    # Copy everything over in batches, truncating the vectors on the way
+    source_collection = source._collection
+    count = source_collection.count()
+    for offset in range(0, count, BATCH_SIZE):
+        batch = source_collection.get(
+            include=["documents", "metadatas", "embeddings"],
+            limit=BATCH_SIZE,
+            offset=offset
+        )
+        target_store._collection.upsert(
+            ids=batch["ids"],
+            documents=batch["documents"],
+            metadatas=batch["metadatas"],
+            embeddings=truncate_vectors(batch["embeddings"], dimension)
+        )
+
+    # Swap the new collection in under the old name
+    if replace:
+        source._client.delete_collection(collection)
+        target_store._collection.modify(name=collection)
+        # Forget the cached stores, so the next get_vector_store() picks up the renamed collection
+        # (other server processes notice within STORE_CHECK_SECONDS, or right away when a search hits the old ID)
+        vector_store_cache = vectordb_service.vector_store
+        vector_store_cache.pop(collection, None)
+        vector_store_cache.pop(target, None)
+        target = collection
+
+    after_ingest(target)
+
+    return {
+        "collection": target,
+        "vectors": count,
+        "old_dimension": source_dimension,
+        "new_dimension": dimension,
+        # float32 vectors are 4 bytes per dimension
+        "old_vector_bytes": count * source_dimension * 4,
+        "new_vector_bytes": count * dimension * 4
+    }
+
+
+# Command line usage (run from the DinoAPI folder):
+    # python -m app.services.dimension_migration_service dino_docs 256 --replace
+# Check the recall/latency tradeoff first with: python -m app.benchmarks.matryoshka_benchmark
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate a collection to a Matryoshka truncated dimension")
+    parser.add_argument("collection")
+    parser.add_argument("dimension", type=int, choices=MATRYOSHKA_DIMENSIONS)
+    parser.add_argument("--target", help="Name of the new collection (default: <collection>_<dimension>d)")
+    parser.add_argument("--replace", action="store_true", help="Replace the old collection with the new one")
+    args = parser.parse_args()
+
+    print(migrate_collection(args.collection, args.dimension, args.target, args.replace))
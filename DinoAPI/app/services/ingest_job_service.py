@@ -0,0 +1,297 @@
+import os
+import threading
+import time
+
+from sqlalchemy import and_, or_, func
+from sqlalchemy.dialects.sqlite import insert
+
+from app.models.ingest_job_db_model import IngestJobDBModel, IngestRateLimitDBModel, InteractiveRequestDBModel
+from app.services.cancellation_service import MAX_DEADLINE_SECONDS
+from app.services.db_connection import LocalSession
+from app.services.vectordb_service import prepare_chunks, get_vector_store, after_ingest
+
+# This service runs ingestion in the BACKGROUND instead of inside the HTTP request
+# Jobs get stored in the ingest_jobs table (our persistent queue) and a small pool of
+# worker threads picks them up, chunks the text, and embeds it a batch at a time
+
+# Priority levels users can pick from (higher number = picked up first)
+PRIORITIES = {"low": 0, "normal": 1, "high": 2}
+
+WORKER_COUNT = int(os.getenv("INGEST_WORKERS", "2"))
+BATCH_SIZE = 16 # How many chunks get embedded per call to the embedding model
+POLL_SECONDS = 1.0 # How long an idle worker waits before checking the queue again
+
+# Global limit on how many chunks we embed per second (shared by every worker in EVERY uvicorn process)
+# This keeps bulk ingestion from hogging the Ollama instance that chat traffic also uses
+EMBEDDINGS_PER_SECOND = float(os.getenv("INGEST_EMBEDDINGS_PER_SECOND", "20"))
+
+# Retry settings - a failed job waits BACKOFF_SECONDS * 2^(attempt - 1) before trying again
+MAX_ATTEMPTS = 3
+BACKOFF_SECONDS = 5.0
+
+# If a running job's worker hasn't checked in for this long, we assume it crashed
+# and let another worker (or another uvicorn process) pick the job back up
+LEASE_SECONDS = 120.0
+
+# How long a bulk job will pause for interactive traffic before it goes ahead anyway (no starving!)
+MAX_PREEMPT_WAIT_SECONDS = 30.0
+
+# How often a paused worker re-checks the DB for interactive traffic
+THROTTLE_POLL_SECONDS = 0.2
+
+
+# A token bucket rate limiter - it refills "rate" tokens per second and each embedding costs one token
+# The bucket is a row in app.db (IngestRateLimitDBModel), so all the uvicorn processes spend from the SAME bucket
+# (an in-memory bucket per process would let N processes embed N times the configured rate)
+class RateLimiter:
+
+    def __init__(self, rate:float):
+        self.rate = rate
+
+    # Block until we have "amount" tokens available, then spend them
+    def acquire(self, amount:int):
+        # Refill the bucket based on how much time passed (capped at one second's worth,
+        # unless a single request needs more than that)
+        capacity = max(self.rate, amount)
+        while True:
+            now = time.time()
+            with LocalSession() as db:
+                # Make sure the bucket exists (starts full)
+                db.execute(insert(IngestRateLimitDBModel).values(id=1, tokens=self.rate, updated_at=now)
+                           .on_conflict_do_nothing())
+
+                # Refill + spend in ONE conditional UPDATE, so two processes can't spend the same tokens
+                # If there aren't enough tokens yet, 0 rows change
+                refilled = func.min(capacity, IngestRateLimitDBModel.tokens
+                                    + (now - IngestRateLimitDBModel.updated_at) * self.rate)
+                spent = (
+                    db.query(IngestRateLimitDBModel)
+                    .filter(IngestRateLimitDBModel.id == 1, refilled >= amount)
+                    .update({"tokens": refilled - amount, "updated_at": now}, synchronize_session=False)
+                )
+                db.commit()
+                if spent == 1:
+                    return
+
+                bucket = db.get(IngestRateLimitDBModel, 1)
+                tokens = min(capacity, bucket.tokens + (now - bucket.updated_at) * self.rate)
+            time.sleep(min(max((amount - tokens) / self.rate, 0.0), 1.0))
+
+
+rate_limiter = RateLimiter(EMBEDDINGS_PER_SECOND)
+
+# ===================(INTERACTIVE PREEMPTION)===================
+
+# Interactive (chat/RAG) requests in flight get a row in the interactive_requests table while they run
+# While there are any rows, bulk ingestion pauses between batches so chat gets Ollama first
+# It's in app.db (not a counter in memory) so chat on ONE uvicorn process pauses the ingest workers in ALL of them
+# A request can't run longer than MAX_DEADLINE_SECONDS, so older rows are leftovers from a crashed process
+STALE_INTERACTIVE_SECONDS = MAX_DEADLINE_SECONDS
+
+# FastAPI dependency for interactive endpoints - add it with Depends() and bulk ingestion
+# will step aside while the request is running
+def interactive_traffic():
+    with LocalSession() as db:
+        row = InteractiveRequestDBModel(started_at=time.time())
+        db.add(row)
+        db.commit()
+        row_id = row.id
+    try:
+        yield
+    finally:
+        with LocalSession() as db:
+            db.query(InteractiveRequestDBModel).filter(InteractiveRequestDBModel.id == row_id).delete()
+            db.commit()
+
+# How many interactive requests are running right now (in every process)
+def interactive_count() -> int:
+    with LocalSession() as db:
+        return (
+            db.query(InteractiveRequestDBModel)
+            .filter(InteractiveRequestDBModel.started_at > time.time() - STALE_INTERACTIVE_SECONDS)
+            .count()
+        )
+
+# Workers call this before every embedding batch
+def _wait_for_interactive_idle():
+    give_up_at = time.monotonic() + MAX_PREEMPT_WAIT_SECONDS
+    while interactive_count() > 0 and time.monotonic() < give_up_at and not _stop.is_set():
+        time.sleep(THROTTLE_POLL_SECONDS)
+
+# ===================(JOB QUEUE FUNCTIONS)===================
+
+# Turn a job row into a dict for the API (leaving out the full text, which could be huge)
+def job_to_dict(job:IngestJobDBModel) -> dict:
+    return {
+        "id": job.id,
+        "collection": job.collection,
+        "priority": next(name for name, value in PRIORITIES.items() if value == job.priority),
+        "status": job.status,
+        "attempts": job.attempts,
+        "chunks_total": job.chunks_total,
+        "chunks_done": job.chunks_done,
+        "error": job.error
+    }
+
+
+# Put a new job in the queue
+def submit_job(collection:str, text:str, priority:str="normal") -> dict:
+    now = time.time()
+    with LocalSession() as db:
+        job = IngestJobDBModel(
+            collection=collection,
+            text=text,
+            priority=PRIORITIES[priority],
+            status="queued",
+            attempts=0,
+            max_attempts=MAX_ATTEMPTS,
+            next_run_at=now,
+            chunks_done=0,
+            created_at=now,
+            updated_at=now
+        )
+        db.add(job)
+        db.commit()
+        db.refresh(job)
+        return job_to_dict(job)
+
+
+# Get a job's status (None if it doesn't exist)
+def get_job(job_id:int) -> dict | None:
+    with LocalSession() as db:
+        job = db.get(IngestJobDBModel, job_id)
+        return job_to_dict(job) if job else None
+
+
+# Cancel a job. Queued jobs never run, running jobs stop before their next batch
+def cancel_job(job_id:int) -> dict | None:
+    with LocalSession() as db:
+        job = db.get(IngestJobDBModel, job_id)
+        if job is None:
+            return None
+        if job.status in ("queued", "running"):
+            job.status = "cancelled"
+            job.updated_at = time.time()
+            db.commit()
+        return job_to_dict(job)
+
+
+# Grab the next job for a worker to run (or None if there's nothing to do)
+def _claim_job(db) -> int | None:
+    now = time.time()
+
+    # Either a queued job whose backoff is over, or a running job whose worker stopped checking in
+    candidate = (
+        db.query(IngestJobDBModel)
+        .filter(or_(
+            and_(IngestJobDBModel.status == "queued", IngestJobDBModel.next_run_at <= now),
+            and_(IngestJobDBModel.status == "running", IngestJobDBModel.heartbeat_at < now - LEASE_SECONDS)
+        ))
+        .order_by(IngestJobDBModel.priority.desc(), IngestJobDBModel.id)
+        .first()
+    )
+    if candidate is None:
+        return None
+
+    # Claim it with a conditional UPDATE - if another worker got there first, 0 rows change
+    claimed = (
+        db.query(IngestJobDBModel)
+        .filter(IngestJobDBModel.id == candidate.id, IngestJobDBModel.updated_at == candidate.updated_at)
+        .update({
+            "status": "running",
+            "attempts": candidate.attempts + 1,
+            "heartbeat_at": now,
+            "updated_at": now
+        })
+    )
+    db.commit()
+    return candidate.id if claimed == 1 else None
+
+
+# Run one job: chunk the text, then embed + store it one batch at a time
+def _run_job(db, job_id:int):
+    job = db.get(IngestJobDBModel, job_id)
+
+    try:
+        vector_docs, chunk_ids = prepare_chunks(job.collection, job.text)
+        job.chunks_total = len(vector_docs)
+        db.commit()
+
+        store = get_vector_store(job.collection)
+
+        # Start from chunks_done, so a retried job doesn't re-embed what already made it in
+        for start in range(job.chunks_done, len(vector_docs), BATCH_SIZE):
+
+            # Stop early if someone cancelled the job
+            db.refresh(job)
+            if job.status == "cancelled":
+                return
+
+            # Let interactive traffic go first (high priority jobs don't wait)
+            if job.priority < PRIORITIES["high"]:
+                _wait_for_interactive_idle()
+
+            batch = vector_docs[start:start + BATCH_SIZE]
+            rate_limiter.acquire(len(batch))
+            store.add_documents(batch, ids=chunk_ids[start:start + BATCH_SIZE])
+
+            job.chunks_done = start + len(batch)
+            job.heartbeat_at = job.updated_at = time.time()
+            db.commit()
+
+        after_ingest(job.collection, coalesce=True)
+
+        db.refresh(job)
+        if job.status != "cancelled":
+            job.status = "done"
+            job.error = None
+            job.updated_at = time.time()
+            db.commit()
+
+    except Exception as e:
+        db.rollback()
+        db.refresh(job)
+        job.error = str(e)
+        job.updated_at = time.time()
+
+        # Out of attempts? Then it failed for good. Otherwise back in the queue with exponential backoff
+        if job.status == "cancelled":
+            pass
+        elif job.attempts >= job.max_attempts:
+            job.status = "failed"
+        else:
+            job.status = "queued"
+            job.next_run_at = time.time() + BACKOFF_SECONDS * 2 ** (job.attempts - 1)
+        db.commit()
+
+# ===================(WORKER POOL)===================
+
+_workers: list[threading.Thread] = []
+_stop = threading.Event()
+
+# The loop each worker thread runs until the app shuts down
+def _worker_loop():
+    while not _stop.is_set():
+        with LocalSession() as db:
+            job_id = _claim_job(db)
+            if job_id is not None:
+                _run_job(db, job_id)
+                continue
+        _stop.wait(POLL_SECONDS)
+
+
+# Start the worker pool (called when the app starts up - see main.py)
+def start_workers():
+    _stop.clear()
+    for index in range(WORKER_COUNT):
+        worker = threading.Thread(target=_worker_loop, name=f"ingest-worker-{index}", daemon=True)
+        worker.start()
+        _workers.append(worker)
+
+
+# Stop the worker pool (running jobs finish their current batch first)
+def stop_workers():
+    _stop.set()
+    for worker in _workers:
+        worker.join(timeout=10)
+    _workers.clear()
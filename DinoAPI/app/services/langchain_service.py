@@ -1,16 +1,29 @@
 # This service will store different chains that help us query our LLM
 # A chain is sequence of actions that we can send to the LLM in one go.
 # LangCHAIN is all about building CHAINS that help us get good responses from the LLM
+import re
+import threading
+from collections import OrderedDict
+from contextlib import aclosing
+
 from langchain_classic.chains.conversation.base import ConversationChain
 from langchain_classic.memory import ConversationBufferWindowMemory
+from langchain_core.messages import AIMessage, HumanMessage
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_ollama import ChatOllama
+from langchain_core.runnables import RunnableLambda
+from pydantic import ValidationError
 
-# Define the LLM we're going to use (llama3.2:3b which we installed locally)
-llm = ChatOllama(
-    model="llama3.2:3b", # The model we're using
-    temperature=0.5 # Temp goes from 0-1. Higher temp = more creative responses from the LLM
-)
+from app.models.dino_model import DinoModel
+from app.services.model_cascade_service import cascade_model
+
+# Define the LLMs we're going to use - one per chain (or chain step), so each one can have its own settings
+# cascade_model() starts with a small local model and only uses llama3.2:3b when it has to
+# The settings (models, temperature, when to skip the small model) live in model_cascade_service.model_settings
+# Temp goes from 0-1. Higher temp = more creative responses from the LLM
+chat_llm = cascade_model("langchain.chat")
+draft_llm = cascade_model("langchain.draft")
+refine_llm = cascade_model("langchain.refine")
+memory_llm = cascade_model("langchain.memory")
 
 # Define the prompt we'll send to the LLM to define tone, context, and instructions
 prompt = ChatPromptTemplate.from_messages([
@@ -31,33 +44,82 @@ prompt = ChatPromptTemplate.from_messages([
 def get_basic_chain():
     # This basic chain was defined using LCEL (LangChain Expression Language)
     # The components in it are just the llm and prompt we defined above
-    chain = prompt | llm
+    chain = prompt | chat_llm
     return chain # Return an invokable chain! Check it out in our langchain_ops router
 
+# ===================(REFINED ANSWERS)===================
+# Both /refined-chat paths (the sequential chain AND the streaming version) draft an answer first,
+# then refine the DRAFT with the same prompt - so ?stream=true and the default path answer the same way
+
+# The refined answer can be at most this many sentences
+SENTENCE_LIMIT = 3
+
+# Refinement prompt - it gets the draft as its input and ONLY writes the refined answer
+# (The original answer is the draft itself, so the LLM doesn't have to re-type it)
+refine_prompt = ChatPromptTemplate.from_messages([
+    ("system",
+     f"""You are a stoic and professional chatbot. 
+     You take raw LLM answers and refine them to be more concise and professional.
+     Format your text generation in {SENTENCE_LIMIT} or less sentences. 
+     Share ONLY the refined answer."""),
+    ("user", "{input}")
+])
+
 # Sequential chain that adds an extra step in the to refine the initial response
 def get_sequential_chain():
 
     # First chain - just a basic prompt to the LLM. Using the OG members from above
-    draft_chain = prompt | llm
+    draft_chain = prompt | draft_llm
 
-    # Define a new prompt to help us refine the initial answer
-    # In this case, we want a more concise and professional answer. No crazy rambling
-    refined_prompt = ChatPromptTemplate.from_messages([
-        ("system",
-         """You are a stoic and professional chatbot. 
-         You take raw LLM answers and refine them to be more concise and professional.
-         Format your text generation in 3 or less sentences. 
-         Share the refined answer, followed by the original answer"""),
-        ("user", "{input}")
-    ])
+    # Make the second chain using the refine prompt (the draft AIMessage becomes the prompt's {input})
+    refined_chain = RunnableLambda(lambda draft: {"input": draft.content}) | refine_prompt | refine_llm
 
-    # Make the second chain using the refined prompt
-    refined_chain = refined_prompt | llm
+    # Same rule as the streaming version: if the draft already fits the sentence limit, it IS the answer
+    # (A RunnableLambda that returns a Runnable runs it on the same input - returning the message just passes it on)
+    def refine_or_skip(draft:AIMessage):
+        if count_sentences(draft.content) <= SENTENCE_LIMIT:
+            return draft
+        return refined_chain
 
     # Finally, the sequential part - combine the 2 chains and return the final chain!
-    sequential_chain = draft_chain | refined_chain
+    sequential_chain = draft_chain | RunnableLambda(refine_or_skip)
     return sequential_chain
 
+# Quick and dirty sentence counter (splits on . ! or ? followed by whitespace)
+def count_sentences(text:str) -> int:
+    return len([sentence for sentence in re.split(r"(?<=[.!?])\s+", text.strip()) if sentence])
+
+
+# Streaming version of the sequential chain
+# This is an async GENERATOR that yields events as soon as tokens come out of the LLM:
+    # {"stage": "draft", "token": ...} while the draft is generating
+    # {"stage": "refined", "token": ...} while the refinement is generating
+    # {"stage": "done", "original": ..., "refined": ..., "refinement_skipped": ...} at the very end
+async def stream_refined_answer(user_input:str, skip_short:bool=True):
+
+    # Stage 1: stream the draft to the client while we collect it for the refinement stage
+    # aclosing() makes sure the LLM stream gets closed right away if the client leaves mid-stream
+    # (otherwise it stays open, and Ollama keeps generating, until the garbage collector gets to it)
+    draft = ""
+    async with aclosing((prompt | draft_llm).astream({"input": user_input})) as chunks:
+        async for chunk in chunks:
+            draft += chunk.content
+            yield {"stage": "draft", "token": chunk.content}
+
+    # If the draft already fits the sentence limit, there's nothing to refine - skip the second LLM call
+    if skip_short and count_sentences(draft) <= SENTENCE_LIMIT:
+        yield {"stage": "done", "original": draft, "refined": draft, "refinement_skipped": True}
+        return
+
+    # Stage 2: stream the refinement, which starts the moment the draft's last token arrives
+    refined = ""
+    async with aclosing((refine_prompt | refine_llm).astream({"input": draft})) as chunks:
+        async for chunk in chunks:
+            refined += chunk.content
+            yield {"stage": "refined", "token": chunk.content}
+
+    yield {"stage": "done", "original": draft, "refined": refined, "refinement_skipped": False}
+
 # A Chain that stores memory so it can recall what was being talked about
 def get_memory_chain():
 
@@ -88,10 +150,92 @@ def get_memory_chain():
     # Chain - we have to use an older clunkier syntax to use memory here
     # (Remember the Chain and Memory stuff in week 2 is kind of outdated...)
     memory_chain = ConversationChain(
-        llm = llm,
+        llm = memory_llm,
         memory = memory,
         prompt = memory_prompt
     )
 
     # Return the chain with memory, invoked in the router endpoint
-    return memory_chain
\ No newline at end of file
+    return memory_chain
+
+# ===================(STRUCTURED DINO RECOMMENDATIONS)===================
+
+# The JSON schema the LLM's output MUST follow - DinoModel's schema without the "id" (we don't want the LLM making IDs)
+DINO_REC_SCHEMA = DinoModel.model_json_schema()
+DINO_REC_SCHEMA["properties"].pop("id", None)
+
+# The small model's recommendation only counts if it's a valid DinoModel - otherwise the large model does it
+def is_valid_recommendation(message) -> bool:
+    try:
+        DinoModel.model_validate_json(message.content)
+        return True
+    except ValidationError:
+        return False
+
+# A second LLM instance that uses Ollama's FORMAT-CONSTRAINED decoding
+# Passing a JSON schema as "format" means the model literally can't generate tokens that break the schema
+# Temperature 0 (see model_settings) so the same preferences give the same recommendation (which makes caching fair)
+structured_llm = cascade_model(
+    "langchain.dino_recs",
+    accept=is_valid_recommendation,
+    format=DINO_REC_SCHEMA
+)
+
+rec_prompt = ChatPromptTemplate.from_messages([
+    ("system",
+     """You give dinosaur recommendations based on user preferences.
+     The user will tell you what they like, and you will respond with ONE recommendation.
+     If the user does not give any preferences, recommend a popular dinosaur.
+     Respond with a JSON object with the dinosaur's "species" and the geological "period" it lived in."""),
+    ("user", "{input}")
+])
+
+# How many times we let the LLM fix invalid output before giving up
+MAX_REPAIR_ATTEMPTS = 2
+
+# Cache of recommendations we've already generated, keyed by the (normalized) user input
+# OrderedDict lets us throw away the oldest entry when it gets too big (a simple LRU cache)
+# The endpoint runs in FastAPI's thread pool, so the lock stops two requests from moving/evicting at the same time
+# (without it, one thread's move_to_end can hit a key another thread just evicted - KeyError)
+REC_CACHE_SIZE = 256
+rec_cache: OrderedDict[str, DinoModel] = OrderedDict()
+rec_cache_lock = threading.Lock()
+
+
+# Get a validated DinoModel recommendation for the user's preferences
+# Raises a ValueError if the LLM still can't produce valid output after the repair attempts
+def get_dino_recommendation(preferences:str) -> DinoModel:
+
+    # Normalize the input so "I like  BIG dinos" and "i like big dinos" hit the same cache entry
+    cache_key = " ".join(preferences.lower().split())
+    with rec_cache_lock:
+        if cache_key in rec_cache:
+            rec_cache.move_to_end(cache_key)
+            return rec_cache[cache_key]
+
+    messages = rec_prompt.format_messages(input=preferences)
+
+    # First attempt + a bounded number of repairs
+    for _ in range(1 + MAX_REPAIR_ATTEMPTS):
+        response = structured_llm.invoke(messages)
+        try:
+            # Validate on the server so clients never see bad JSON
+            recommendation = DinoModel.model_validate_json(response.content)
+            break
+        except ValidationError as e:
+            # REPAIR: show the LLM what it said and what was wrong with it, then ask again
+            messages = messages + [
+                AIMessage(content=response.content),
+                HumanMessage(content=f"That JSON was invalid: {e.errors(include_url=False)}. Return a corrected JSON object.")
+            ]
+    else:
+        raise ValueError("The LLM could not produce a valid dino recommendation")
+
+    # (The LLM call above stays OUTSIDE the lock, so a slow generation never blocks cache hits)
+    with rec_cache_lock:
+        rec_cache[cache_key] = recommendation
+        rec_cache.move_to_end(cache_key)
+        if len(rec_cache) > REC_CACHE_SIZE:
+            rec_cache.popitem(last=False) # Throw out the least recently used entry
+
+    return recommendation
@@ -1,17 +1,17 @@
 from typing import TypedDict, Any
 
-from langchain_ollama import ChatOllama
 from langgraph.graph import StateGraph
 
+from app.services.model_cascade_service import cascade_model
+from app.services.tracing_service import traced_node
 from app.services.vectordb_service import search
 
 # This Service will define the State, Nodes, and Graph for our LangGraph implementation
 
-# First, just wanna define the LLM we'll use
-llm = ChatOllama(
-    model="llama3.2:3b",
-    temperature=0.5
-)
+# First, just wanna define the LLMs we'll use
+# Each node gets its own model from the cascade (small model first, large one when it's needed - see model_cascade_service)
+answer_llm = cascade_model("langgraph.answer_with_docs")
+chat_llm = cascade_model("langgraph.general_chat")
 
 # This is the State object for our Graph
 # Like in React, State holds data that we want to keep track of
@@ -92,7 +92,7 @@ def answer_with_docs(state:GraphState) -> GraphState:
     )
 
     # Invoke the LLM! And save the answer in state
-    response = llm.invoke(prompt)
+    response = answer_llm.invoke(prompt)
     return {"answer":response.text}
 
 # Here's the general chat node that we fall back to if the query isn't related to vector data
@@ -113,7 +113,7 @@ def general_chat_node(state:GraphState) -> GraphState:
     )
 
     # Return the invocation and store it in State
-    response = llm.invoke(prompt)
+    response = chat_llm.invoke(prompt)
     return {"answer":response.text}
 
 
@@ -128,12 +128,12 @@ def build_graph():
     # First, define the graph builder using the State Graph
     build = StateGraph(GraphState)
 
-    # Register each node
-    build.add_node("route", route_node)
-    build.add_node("search_dinos", search_dinos)
-    build.add_node("search_plans", search_plans)
-    build.add_node("answer_with_docs", answer_with_docs)
-    build.add_node("general_chat", general_chat_node)
+    # Register each node (traced_node makes each node show up as a span in the request's trace)
+    build.add_node("route", traced_node("route", route_node))
+    build.add_node("search_dinos", traced_node("search_dinos", search_dinos))
+    build.add_node("search_plans", traced_node("search_plans", search_plans))
+    build.add_node("answer_with_docs", traced_node("answer_with_docs", answer_with_docs))
+    build.add_node("general_chat", traced_node("general_chat", general_chat_node))
 
     # Set the node that starts the graph (router node in this case)
     build.set_entry_point("route")
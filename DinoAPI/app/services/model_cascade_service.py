@@ -0,0 +1,354 @@
+import os
+import threading
+import time
+from contextlib import aclosing, closing
+from typing import Any, Callable, Literal
+
+import ollama
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.runnables import Runnable
+from pydantic import BaseModel
+
+from app.services.admission_service import AdmissionRejected
+from app.services.cancellation_service import RequestCancelled
+from app.services.ollama_client_service import CHAT_MODEL, chat_model
+
+# This service is the MODEL CASCADE - every node and chain gets the cheapest model that can handle its request
+# There are two tiers:
+    # small - a 1B model. Way faster, good enough for greetings, simple questions and routing decisions
+    # large - the 3B model we've always used
+# For each call (with tier "cascade"):
+    # Long prompts go straight to the large model (lots of docs or a long question = not a simple request)
+    # Everything else goes to the small model first
+    # If the small model's answer doesn't look confident (hedging, empty, cut off...), the large model answers instead
+# Streamed calls can't take back tokens that were already sent, so they only get the prompt length check
+# If the small model FAILS (not pulled, crashed...), the large model answers instead - the small tier is an
+# optimization, it should never take down endpoints that worked with just the 3B
+# Every node/chain has its own settings in model_settings, and per-tier usage is reported at /debug/models
+
+SMALL_CHAT_MODEL = os.getenv("OLLAMA_SMALL_CHAT_MODEL", "llama3.2:1b")
+LARGE_CHAT_MODEL = CHAT_MODEL
+
+# Turn the cascade off and everything uses the large model (like before we had tiers)
+MODEL_CASCADE = os.getenv("MODEL_CASCADE", "true").lower() == "true"
+
+# A small model Ollama doesn't have (404) gets skipped for this long before we try it again
+SMALL_MODEL_RETRY_SECONDS = float(os.getenv("MODEL_CASCADE_RETRY_SECONDS", "300"))
+
+# These errors mean "stop this request", not "the small model is broken" - they never fall back
+STOP_ERRORS = (RequestCancelled, AdmissionRejected)
+
+# If the small model's answer contains one of these, it's not sure about it - escalate
+HEDGES = (
+    "i'm not sure", "i am not sure", "i'm not certain", "i don't know", "i do not know",
+    "i cannot answer", "i can't answer", "i'm unable", "i am unable", "not enough information"
+)
+
+
+# One node's (or chain's) model settings
+class ModelSettings(BaseModel):
+    tier: Literal["cascade", "small", "large"] = "cascade" # "small"/"large" pins the node to that tier
+    temperature: float = 0.5
+    small_model: str = SMALL_CHAT_MODEL
+    large_model: str = LARGE_CHAT_MODEL
+    max_small_prompt_chars: int = 1200 # Longer prompts skip the small model
+
+
+# Settings for every node and chain that calls the LLM (anything missing gets the defaults)
+# Routing is a small decision, so the router gets the small model even with its long system prompt
+# answer_with_docs prompts include the search results, so they get more room before going straight to large
+model_settings: dict[str, ModelSettings] = {
+    "agentic.route": ModelSettings(max_small_prompt_chars=4000),
+    "agentic.answer_with_docs": ModelSettings(max_small_prompt_chars=6000),
+    "agentic.general_chat": ModelSettings(),
+    "langgraph.answer_with_docs": ModelSettings(max_small_prompt_chars=6000),
+    "langgraph.general_chat": ModelSettings(),
+    "langchain.chat": ModelSettings(),
+    "langchain.draft": ModelSettings(),
+    "langchain.refine": ModelSettings(max_small_prompt_chars=2000), # Its prompt is the whole draft
+    "langchain.memory": ModelSettings(max_small_prompt_chars=3000), # Its prompt has the conversation history
+    "langchain.dino_recs": ModelSettings(temperature=0)
+}
+
+# Usage counters per tier, plus how each node/chain got split between them
+cascade_stats = {
+    "tiers": {
+        tier: {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "seconds": 0.0}
+        for tier in ("small", "large")
+    },
+    "escalations": 0,
+    "fallbacks": 0, # Small model calls that FAILED, so the large model answered
+    "last_fallback_error": None,
+    "by_role": {}
+}
+_stats_lock = threading.Lock()
+
+# Models Ollama said it doesn't have -> time.monotonic() when we can try them again
+_unavailable_until: dict[str, float] = {}
+
+
+def record_call(role:str, tier:str, message:BaseMessage | None, seconds:float, escalated:bool=False):
+    usage = getattr(message, "usage_metadata", None) or {}
+    with _stats_lock:
+        tier_stats = cascade_stats["tiers"][tier]
+        tier_stats["calls"] += 1
+        tier_stats["prompt_tokens"] += usage.get("input_tokens", 0)
+        tier_stats["completion_tokens"] += usage.get("output_tokens", 0)
+        tier_stats["seconds"] += seconds
+
+        role_stats = cascade_stats["by_role"].setdefault(role, {"small": 0, "large": 0, "escalated": 0, "fallbacks": 0})
+        role_stats[tier] += 1
+        if escalated:
+            cascade_stats["escalations"] += 1
+            role_stats["escalated"] += 1
+
+
+def record_fallback(role:str, model:str, error:Exception):
+    # Model not pulled? Don't bother asking for it on every request
+    if isinstance(error, ollama.ResponseError) and error.status_code == 404:
+        _unavailable_until[model] = time.monotonic() + SMALL_MODEL_RETRY_SECONDS
+    with _stats_lock:
+        cascade_stats["fallbacks"] += 1
+        cascade_stats["last_fallback_error"] = f"{model}: {error!r}"[:300]
+        cascade_stats["by_role"].setdefault(role, {"small": 0, "large": 0, "escalated": 0, "fallbacks": 0})["fallbacks"] += 1
+
+
+def is_available(model:str) -> bool:
+    return time.monotonic() >= _unavailable_until.get(model, 0.0)
+
+
+# Stats plus the numbers we actually care about (how much of the traffic the small model handles)
+def get_cascade_stats() -> dict:
+    with _stats_lock:
+        tiers = {tier: dict(stats) for tier, stats in cascade_stats["tiers"].items()}
+        by_role = {role: dict(counts) for role, counts in cascade_stats["by_role"].items()}
+        escalations = cascade_stats["escalations"]
+        fallbacks = cascade_stats["fallbacks"]
+        last_fallback_error = cascade_stats["last_fallback_error"]
+
+    for tier, stats in tiers.items():
+        stats["seconds"] = round(stats["seconds"], 3)
+        stats["average_seconds"] = round(stats["seconds"] / stats["calls"], 3) if stats["calls"] else 0.0
+
+    small_attempts = tiers["small"]["calls"]
+    total_calls = small_attempts + tiers["large"]["calls"]
+    return {
+        "enabled": MODEL_CASCADE,
+        "models": {"small": SMALL_CHAT_MODEL, "large": LARGE_CHAT_MODEL},
+        "tiers": tiers,
+        "escalations": escalations,
+        "fallbacks": fallbacks,
+        "last_fallback_error": last_fallback_error,
+        "unavailable_models": [model for model in _unavailable_until if not is_available(model)],
+        # Share of the small model's answers that got thrown away for the large model's
+        "escalation_rate": escalations / small_attempts if small_attempts else 0.0,
+        # Share of requests the small model answered on its own
+        "small_share": (small_attempts - escalations) / (total_calls - escalations) if total_calls else 0.0,
+        "by_role": by_role,
+        "settings": {role: settings.model_dump() for role, settings in model_settings.items()}
+    }
+
+
+# The default confidence check for the small model's answers
+def looks_confident(message:BaseMessage) -> bool:
+    text = message.text.strip().lower()
+    if not text:
+        return False
+    # done_reason "length" means the answer got cut off at the token limit
+    if message.response_metadata.get("done_reason") == "length":
+        return False
+    return not any(hedge in text for hedge in HEDGES)
+
+
+# A chat model that picks the small or large model for every call (see the top of the file)
+# It works anywhere a chat model does: in chains, ConversationChain, streaming, and with bind_tools()
+class CascadeChatModel(BaseChatModel):
+    role:str # The model_settings key, like "agentic.route"
+    tier:Literal["cascade", "small", "large"]
+    max_small_prompt_chars:int
+    small_model:str # The small tier's model name (so we can skip it while Ollama doesn't have it)
+    small:Runnable
+    large:Runnable
+    accept:Callable[[BaseMessage], bool] | None = None # Confidence check (defaults to looks_confident)
+
+    @property
+    def _llm_type(self) -> str:
+        return "cascade"
+
+    # Which tier to START with
+    def _pick(self, messages:list[BaseMessage]) -> str:
+        if self.tier != "cascade":
+            return "large" if self.tier == "small" and not is_available(self.small_model) else self.tier
+        if not is_available(self.small_model):
+            return "large"
+        prompt_chars = sum(len(message.text) for message in messages)
+        return "small" if prompt_chars <= self.max_small_prompt_chars else "large"
+
+    def _accepts(self, message:BaseMessage) -> bool:
+        return (self.accept or looks_confident)(message)
+
+    # Does the small model's answer stand? (pinned "small" nodes always keep it)
+    def _keeps(self, message:BaseMessage) -> bool:
+        return self.tier != "cascade" or self._accepts(message)
+
+    # Ask the small model. Returns None if it failed (the caller falls back to the large model)
+    def _try_small(self, messages, stop, **kwargs) -> BaseMessage | None:
+        start = time.perf_counter()
+        try:
+            message = self.small.invoke(messages, stop=stop, **kwargs)
+        except STOP_ERRORS:
+            raise
+        except Exception as e:
+            record_fallback(self.role, self.small_model, e)
+            return None
+        record_call(self.role, "small", message, time.perf_counter() - start)
+        return message
+
+    async def _atry_small(self, messages, stop, **kwargs) -> BaseMessage | None:
+        start = time.perf_counter()
+        try:
+            message = await self.small.ainvoke(messages, stop=stop, **kwargs)
+        except STOP_ERRORS:
+            raise
+        except Exception as e:
+            record_fallback(self.role, self.small_model, e)
+            return None
+        record_call(self.role, "small", message, time.perf_counter() - start)
+        return message
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        small_message = None
+        if self._pick(messages) == "small":
+            small_message = self._try_small(messages, stop, **kwargs)
+            if small_message is not None and self._keeps(small_message):
+                return ChatResult(generations=[ChatGeneration(message=small_message)])
+
+        # Large model: picked up front, the small model wasn't confident (escalated), or it failed (fallback)
+        start = time.perf_counter()
+        message = self.large.invoke(messages, stop=stop, **kwargs)
+        record_call(self.role, "large", message, time.perf_counter() - start, escalated=small_message is not None)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        small_message = None
+        if self._pick(messages) == "small":
+            small_message = await self._atry_small(messages, stop, **kwargs)
+            if small_message is not None and self._keeps(small_message):
+                return ChatResult(generations=[ChatGeneration(message=small_message)])
+
+        start = time.perf_counter()
+        message = await self.large.ainvoke(messages, stop=stop, **kwargs)
+        record_call(self.role, "large", message, time.perf_counter() - start, escalated=small_message is not None)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    # Streams pick their tier up front and stick with it
+    # (unless the small model fails before its first token - nothing was sent yet, so the large one takes over)
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        if self._pick(messages) == "small":
+            started = False
+            try:
+                for chunk in self._stream_tier("small", messages, stop, **kwargs):
+                    started = True
+                    yield chunk
+                return
+            except STOP_ERRORS:
+                raise
+            except Exception as e:
+                if started:
+                    raise
+                record_fallback(self.role, self.small_model, e)
+        yield from self._stream_tier("large", messages, stop, **kwargs)
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        if self._pick(messages) == "small":
+            started = False
+            try:
+                async with aclosing(self._astream_tier("small", messages, stop, **kwargs)) as chunks:
+                    async for chunk in chunks:
+                        started = True
+                        yield chunk
+                return
+            except STOP_ERRORS:
+                raise
+            except Exception as e:
+                if started:
+                    raise
+                record_fallback(self.role, self.small_model, e)
+        async with aclosing(self._astream_tier("large", messages, stop, **kwargs)) as chunks:
+            async for chunk in chunks:
+                yield chunk
+
+    def _stream_tier(self, tier:str, messages, stop, **kwargs):
+        start = time.perf_counter()
+        usage_chunk = None
+        failed = False
+        try:
+            with closing((self.small if tier == "small" else self.large).stream(messages, stop=stop, **kwargs)) as chunks:
+                for chunk in chunks:
+                    if chunk.usage_metadata:
+                        usage_chunk = chunk # The last chunk carries the token counts
+                    yield ChatGenerationChunk(message=chunk)
+        except Exception:
+            failed = True # Failed calls don't count as usage
+            raise
+        finally:
+            if not failed:
+                record_call(self.role, tier, usage_chunk, time.perf_counter() - start)
+
+    async def _astream_tier(self, tier:str, messages, stop, **kwargs):
+        start = time.perf_counter()
+        usage_chunk = None
+        failed = False
+        try:
+            # aclosing() so a cancelled stream still closes the Ollama stream right away
+            async with aclosing((self.small if tier == "small" else self.large).astream(messages, stop=stop, **kwargs)) as chunks:
+                async for chunk in chunks:
+                    if chunk.usage_metadata:
+                        usage_chunk = chunk
+                    yield ChatGenerationChunk(message=chunk)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            if not failed:
+                record_call(self.role, tier, usage_chunk, time.perf_counter() - start)
+
+    # Bind the tools to both tiers. For a tool-calling model (the router), "confident" means
+    # it called at most one tool, and only a tool that actually exists
+    def bind_tools(self, tools:list, **kwargs) -> "CascadeChatModel":
+        tool_names = {tool.name for tool in tools}
+
+        def valid_tool_calls(message:AIMessage) -> bool:
+            calls = getattr(message, "tool_calls", [])
+            return len(calls) <= 1 and all(call["name"] in tool_names for call in calls)
+
+        return self.model_copy(update={
+            "small": self.small.bind_tools(tools, **kwargs),
+            "large": self.large.bind_tools(tools, **kwargs),
+            "accept": valid_tool_calls
+        })
+
+
+# Build the model for one node or chain from its model_settings entry
+# Extra ChatOllama settings (like format) go to both tiers. accept overrides the confidence check
+def cascade_model(role:str, accept:Callable[[BaseMessage], bool]=None, **kwargs:Any) -> CascadeChatModel:
+    settings = model_settings.get(role, ModelSettings())
+    return CascadeChatModel(
+        role=role,
+        tier=settings.tier if MODEL_CASCADE else "large",
+        max_small_prompt_chars=settings.max_small_prompt_chars,
+        small_model=settings.small_model,
+        small=chat_model(model=settings.small_model, temperature=settings.temperature, **kwargs),
+        large=chat_model(model=settings.large_model, temperature=settings.temperature, **kwargs),
+        accept=accept
+    )
+
+
+# Every model the settings use (so main.py can preload them)
+def configured_models() -> list[str]:
+    models = {settings.large_model for settings in model_settings.values()}
+    if MODEL_CASCADE:
+        models |= {settings.small_model for settings in model_settings.values() if settings.tier != "large"}
+    return sorted(models | {LARGE_CHAT_MODEL})
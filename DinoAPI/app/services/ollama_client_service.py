@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import os
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import ollama
+from langchain_core.embeddings import Embeddings
+
+from app.services.admission_service import AdmittedChatOllama
+
+# This service is the ONE place our app talks to Ollama from
+# Every chat model and the embedding model get built here, so they all share:
+    # Pooled, persistent HTTP connections (no new TCP connection per request)
+    # The same timeouts and connection retries
+    # The same model KEEP ALIVE - how long Ollama keeps a model loaded after its last request
+        # (Ollama's default is 5 minutes, so after a quiet spell the next request pays for reloading the model)
+# Chat and embedding traffic get SEPARATE connection pools, so a burst of ingestion can't use up
+# the connections a chat request needs (and the other way around)
+
+logger = logging.getLogger(__name__)
+
+OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434")
+CHAT_MODEL = os.getenv("OLLAMA_CHAT_MODEL", "llama3.2:3b")
+
+# How long Ollama keeps a model loaded after the last request ("30m", "1h", or "-1" for forever)
+KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+
+# Timeouts (seconds). Generations can take a while, so reads get way more time than connecting does
+CONNECT_TIMEOUT = float(os.getenv("OLLAMA_CONNECT_TIMEOUT_SECONDS", "5"))
+CHAT_READ_TIMEOUT = float(os.getenv("OLLAMA_CHAT_READ_TIMEOUT_SECONDS", "300"))
+EMBEDDING_READ_TIMEOUT = float(os.getenv("OLLAMA_EMBEDDING_READ_TIMEOUT_SECONDS", "60"))
+
+# Retries for failed CONNECTIONS only - nothing was sent yet, so retrying can't run a generation twice
+CONNECT_RETRIES = int(os.getenv("OLLAMA_CONNECT_RETRIES", "2"))
+
+# Max open connections per pool (the admission controller already limits how many generations run at once)
+CHAT_POOL_SIZE = int(os.getenv("OLLAMA_CHAT_POOL_SIZE", "8"))
+EMBEDDING_POOL_SIZE = int(os.getenv("OLLAMA_EMBEDDING_POOL_SIZE", "4"))
+
+# Idle connections get closed after this many seconds
+CONNECTION_IDLE_SECONDS = 60
+
+# Load the models when the server starts, so the first request doesn't wait for them
+PRELOAD_MODELS = os.getenv("OLLAMA_PRELOAD", "true").lower() == "true"
+
+
+# Async connections belong to the event loop that opened them, and break if another loop tries to use them
+# So this transport keeps a separate async pool for each event loop (the server only ever has one)
+class LoopLocalAsyncTransport(httpx.AsyncBaseTransport):
+
+    def __init__(self, limits:httpx.Limits):
+        self.limits = limits
+        self.transports = weakref.WeakKeyDictionary() # Goes away on its own when a loop does
+
+    async def handle_async_request(self, request:httpx.Request) -> httpx.Response:
+        loop = asyncio.get_running_loop()
+        transport = self.transports.get(loop)
+        if transport is None:
+            transport = self.transports[loop] = httpx.AsyncHTTPTransport(limits=self.limits, retries=CONNECT_RETRIES)
+        return await transport.handle_async_request(request)
+
+
+# A connection pool for one kind of traffic
+# httpx keeps the connections in the TRANSPORT, so every client built with the same transport shares them
+# (sync and async clients need their own transport, so each of those gets up to "size" connections)
+class OllamaPool:
+
+    def __init__(self, size:int, read_timeout:float):
+        limits = httpx.Limits(
+            max_connections=size,
+            max_keepalive_connections=size,
+            keepalive_expiry=CONNECTION_IDLE_SECONDS
+        )
+        self.timeout = httpx.Timeout(read_timeout, connect=CONNECT_TIMEOUT)
+        self.transport = httpx.HTTPTransport(limits=limits, retries=CONNECT_RETRIES)
+        self.async_transport = LoopLocalAsyncTransport(limits)
+
+    # Keyword args for ollama.Client (they get passed on to the httpx client underneath)
+    def client_kwargs(self) -> dict:
+        return {"timeout": self.timeout, "transport": self.transport}
+
+    def async_client_kwargs(self) -> dict:
+        return {"timeout": self.timeout, "transport": self.async_transport}
+
+
+chat_pool = OllamaPool(CHAT_POOL_SIZE, CHAT_READ_TIMEOUT)
+embedding_pool = OllamaPool(EMBEDDING_POOL_SIZE, EMBEDDING_READ_TIMEOUT)
+
+
+# Build a chat model that uses the shared chat pool (and still goes through the admission controller)
+# Any ChatOllama setting can be passed in, like temperature or format
+def chat_model(model:str=CHAT_MODEL, **kwargs) -> AdmittedChatOllama:
+    return AdmittedChatOllama(
+        model=model,
+        base_url=OLLAMA_HOST,
+        keep_alive=KEEP_ALIVE,
+        sync_client_kwargs=chat_pool.client_kwargs(),
+        async_client_kwargs=chat_pool.async_client_kwargs(),
+        **kwargs
+    )
+
+
+# Embedding model that uses the shared embedding pool
+# It calls the same /api/embeddings endpoint the old OllamaEmbeddings did, so new vectors match the stored ones
+# That endpoint takes one text per request, so a batch gets spread over the pool's connections
+class PooledOllamaEmbeddings(Embeddings):
+
+    def __init__(self, model:str):
+        self.model = model
+        self.client = ollama.Client(host=OLLAMA_HOST, **embedding_pool.client_kwargs())
+        self.executor = ThreadPoolExecutor(max_workers=EMBEDDING_POOL_SIZE, thread_name_prefix="ollama-embed")
+
+    def embed_query(self, text:str) -> list[float]:
+        response = self.client.embeddings(model=self.model, prompt=text, keep_alive=KEEP_ALIVE)
+        return list(response.embedding)
+
+    def embed_documents(self, texts:list[str]) -> list[list[float]]:
+        if len(texts) <= 1:
+            return [self.embed_query(text) for text in texts]
+        # map() keeps the vectors in the same order as the texts
+        return list(self.executor.map(self.embed_query, texts))
+
+
+# Ask Ollama to load the models now (an empty request just loads the model and applies the keep alive)
+def preload_models(chat_models:list[str], embedding_models:list[str]):
+    chat_client = ollama.Client(host=OLLAMA_HOST, **chat_pool.client_kwargs())
+    embedding_client = ollama.Client(host=OLLAMA_HOST, **embedding_pool.client_kwargs())
+    for model in chat_models:
+        try:
+            chat_client.generate(model=model, prompt="", keep_alive=KEEP_ALIVE)
+        except Exception as e:
+            logger.warning("Couldn't preload chat model %s: %s", model, e)
+    for model in embedding_models:
+        try:
+            embedding_client.embeddings(model=model, prompt="", keep_alive=KEEP_ALIVE)
+        except Exception as e:
+            logger.warning("Couldn't preload embedding model %s: %s", model, e)
+
+
+# Preload in the background, so the server doesn't wait on Ollama to start up
+def start_preload(chat_models:list[str], embedding_models:list[str]):
+    if PRELOAD_MODELS:
+        threading.Thread(
+            target=preload_models,
+            args=(chat_models, embedding_models),
+            name="ollama-preload",
+            daemon=True
+        ).start()
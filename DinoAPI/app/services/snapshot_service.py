@@ -0,0 +1,191 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from app.services.chunking_service import ChunkProfile
+from app.services.vectordb_service import (
+    EMBEDDING_MODEL, IndexSettings, get_vector_store, after_ingest, get_embedding_dimension, get_index_settings,
+    get_chunk_profile, set_chunk_profile
+)
+
+# This service EXPORTS and IMPORTS whole collections as snapshot files
+# A snapshot has everything a collection needs: IDs, texts, metadata, and the vectors themselves
+# So a brand new server can load a snapshot instead of re-embedding the whole corpus through Ollama
+
+# The snapshot is a single .npz file (NumPy's zipped format) with one array per column:
+    # manifest  - JSON with the format version, embedding model, dimension, HNSW index settings, chunk profile,
+    #             dtype, count
+    # ids, texts, metadatas (JSON strings) - each one stored as two arrays (see _pack_strings):
+        # {column}_bytes   - every string's UTF-8 bytes, back to back
+        # {column}_offsets - where each string starts and ends in those bytes
+    # vectors (float32 or float16)
+# Why not just np.array(texts, dtype=str)? That makes a FIXED width UCS-4 array - every string gets padded to
+# the longest one at 4 bytes per character, so one long chunk blows the whole column (and our memory) up
+
+SNAPSHOT_DIRECTORY = "app/snapshots"
+SNAPSHOT_FORMAT_VERSION = 2 # Version 1 stored the string columns as fixed width str arrays (we can still import those)
+STRING_COLUMNS = ("ids", "texts", "metadatas")
+
+# How many rows we read/write per Chroma call
+BATCH_SIZE = 5000
+
+
+def snapshot_path(collection:str) -> str:
+    return os.path.join(SNAPSHOT_DIRECTORY, f"{collection}.npz")
+
+
+# Turn a list of strings into (UTF-8 bytes, offsets) - string i is bytes[offsets[i]:offsets[i + 1]]
+def _pack_strings(strings:list[str]) -> tuple[np.ndarray, np.ndarray]:
+    encoded = [string.encode("utf-8") for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(string) for string in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+# And back again
+def _unpack_strings(data:np.ndarray, offsets:np.ndarray) -> list[str]:
+    raw = data.tobytes()
+    offsets = offsets.tolist()
+    return [raw[start:end].decode("utf-8") for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+# Read one string column out of a snapshot (in whichever format the snapshot was written)
+def _read_strings(snapshot, column:str) -> list[str]:
+    if f"{column}_bytes" in snapshot:
+        return _unpack_strings(snapshot[f"{column}_bytes"], snapshot[f"{column}_offsets"])
+    return snapshot[column].tolist() # Format version 1
+
+
+# Export a collection to a snapshot file. float16 halves the file size (and is plenty precise for search)
+def export_snapshot(collection:str, path:str=None, dtype:str="float32") -> dict:
+
+    if dtype not in ("float32", "float16"):
+        raise ValueError("dtype must be float32 or float16")
+
+    path = path or snapshot_path(collection)
+    store = get_vector_store(collection)
+    chroma_collection = store._collection
+
+    # Read the collection in batches so huge collections don't need one giant query
+    ids, texts, metadatas, vectors = [], [], [], []
+    for offset in range(0, chroma_collection.count(), BATCH_SIZE):
+        batch = chroma_collection.get(
+            include=["documents", "metadatas", "embeddings"],
+            limit=BATCH_SIZE,
+            offset=offset
+        )
+        ids.extend(batch["ids"])
+        texts.extend(text or "" for text in batch["documents"]) # Chunks without a document get an empty one
+        metadatas.extend(json.dumps(metadata or {}) for metadata in batch["metadatas"])
+        vectors.extend(batch["embeddings"])
+
+    vectors = np.asarray(vectors, dtype=dtype)
+    manifest = {
+        "format_version": SNAPSHOT_FORMAT_VERSION,
+        "collection": collection,
+        "embedding_model": EMBEDDING_MODEL,
+        "dimension": int(vectors.shape[1]) if vectors.ndim == 2 else 0,
+        "index_settings": get_index_settings(store).model_dump(),
+        "chunk_profile": get_chunk_profile(collection).model_dump(),
+        "dtype": dtype,
+        "count": len(ids),
+        "created_at": time.time()
+    }
+
+    columns = {}
+    for column, strings in zip(STRING_COLUMNS, (ids, texts, metadatas)):
+        columns[f"{column}_bytes"], columns[f"{column}_offsets"] = _pack_strings(strings)
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    np.savez_compressed(
+        path,
+        manifest=np.array(json.dumps(manifest)),
+        vectors=vectors,
+        **columns
+    )
+    return manifest
+
+
+# Import a snapshot file into a collection (the snapshot's own collection name, unless you pass one)
+# Refuses to load vectors from a different embedding model or with a different dimension,
+# since those vectors would be meaningless next to the ones our queries get embedded with
+def import_snapshot(path:str, collection:str=None) -> dict:
+
+    with np.load(path) as snapshot:
+        manifest = json.loads(str(snapshot["manifest"]))
+
+        if manifest["format_version"] > SNAPSHOT_FORMAT_VERSION:
+            raise ValueError(f"Snapshot format {manifest['format_version']} is newer than this server understands")
+        if manifest["embedding_model"] != EMBEDDING_MODEL:
+            raise ValueError(f"Snapshot was embedded with {manifest['embedding_model']}, but we use {EMBEDDING_MODEL}")
+
+        collection = collection or manifest["collection"]
+        # New collections get created with the snapshot's (possibly Matryoshka truncated) dimension and index settings
+        # (snapshots from before index settings were saved just get the defaults)
+        settings = IndexSettings(**manifest["index_settings"]) if "index_settings" in manifest else None
+        store = get_vector_store(collection, manifest["dimension"] or None, settings)
+        chroma_collection = store._collection
+
+        # If the collection already has vectors, their dimension has to match the snapshot's
+        existing = chroma_collection.get(limit=1, include=["embeddings"])
+        if len(existing["ids"]) > 0 and len(existing["embeddings"][0]) != manifest["dimension"]:
+            raise ValueError(
+                f"Snapshot vectors have {manifest['dimension']} dimensions, "
+                f"but collection '{collection}' has {len(existing['embeddings'][0])}"
+            )
+        # ...and so does the dimension new queries get truncated to
+        if manifest["count"] > 0 and get_embedding_dimension(store) != manifest["dimension"]:
+            raise ValueError(
+                f"Snapshot vectors have {manifest['dimension']} dimensions, "
+                f"but collection '{collection}' embeds queries at {get_embedding_dimension(store)}"
+            )
+
+        ids = _read_strings(snapshot, "ids")
+        texts = _read_strings(snapshot, "texts")
+        metadatas = [json.loads(metadata) or None for metadata in _read_strings(snapshot, "metadatas")]
+        vectors = snapshot["vectors"].astype(np.float32) # float16 snapshots get widened back to float32
+
+    # Text ingested into the collection later gets chunked the same way the snapshot's text was
+    # (snapshots from before chunk profiles were saved keep whatever profile the collection already has)
+    if "chunk_profile" in manifest:
+        set_chunk_profile(collection, ChunkProfile(**manifest["chunk_profile"]))
+
+    # Bulk upsert straight into Chroma - the vectors are already computed, so no embedding calls at all
+    batch_size = min(BATCH_SIZE, chroma_collection._client.get_max_batch_size())
+    for start in range(0, len(ids), batch_size):
+        end = start + batch_size
+        chroma_collection.upsert(
+            ids=ids[start:end],
+            documents=texts[start:end],
+            metadatas=metadatas[start:end],
+            embeddings=vectors[start:end]
+        )
+
+    after_ingest(collection)
+    return {**manifest, "collection": collection}
+
+
+# Command line usage (run from the DinoAPI folder):
+    # python -m app.services.snapshot_service export dino_docs --dtype float16
+    # python -m app.services.snapshot_service import app/snapshots/dino_docs.npz
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export/import vector collection snapshots")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_command = commands.add_parser("export")
+    export_command.add_argument("collection")
+    export_command.add_argument("--path")
+    export_command.add_argument("--dtype", default="float32", choices=["float32", "float16"])
+
+    import_command = commands.add_parser("import")
+    import_command.add_argument("path")
+    import_command.add_argument("--collection")
+
+    args = parser.parse_args()
+    if args.command == "export":
+        print(export_snapshot(args.collection, args.path, args.dtype))
+    else:
+        print(import_snapshot(args.path, args.collection))
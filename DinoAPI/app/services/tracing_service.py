@@ -0,0 +1,170 @@
+import heapq
+import os
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+from app.services.cancellation_service import check_cancelled
+
+# This service does PER-REQUEST TRACING
+# Every request gets a tree of "spans" - each span is one timed step, like:
+    # a LangGraph node, an embedding call, a Chroma query, an LLM call, or a SQL statement
+# Finished traces go into an in-memory RING BUFFER (old ones fall off the end),
+# and we can look at any of them at /debug/traces/{trace_id}
+
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0")) # Fraction of requests to keep (0 to 1)
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "200")) # How many sampled traces we remember
+TRACE_KEEP_SLOWEST = int(os.getenv("TRACE_KEEP_SLOWEST", "20")) # The N slowest traces are ALWAYS kept
+
+
+class Span:
+
+    def __init__(self, name:str, kind:str, attributes:dict):
+        self.name = name
+        self.kind = kind # "request", "node", "embedding", "vector_query", "llm", "sql", ...
+        self.attributes = attributes
+        self.start = time.perf_counter()
+        self.end = None
+        self.children: list[Span] = []
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end or time.perf_counter()) - self.start) * 1000
+
+    # Turn the span (and all its children) into a dict - offsets are relative to the request's start,
+    # which is exactly what you need to draw a waterfall
+    def to_dict(self, origin:float) -> dict:
+        return {
+            "name": self.name,
+            "kind": self.kind,
+            "start_ms": round((self.start - origin) * 1000, 3),
+            "duration_ms": round(self.duration_ms, 3),
+            "attributes": self.attributes,
+            "children": [child.to_dict(origin) for child in list(self.children)]
+        }
+
+
+# The span we're currently inside of (each request/thread gets its own copy thanks to ContextVar)
+current_span: ContextVar[Span | None] = ContextVar("current_span", default=None)
+
+# Sampled traces (a deque with maxlen IS a ring buffer) + a heap of the slowest traces
+_recent: deque[dict] = deque(maxlen=TRACE_BUFFER_SIZE)
+_slowest: list[tuple[float, str, dict]] = []
+_lock = threading.Lock()
+
+
+# Add a LEAF span (one that won't have children) under the current span and return it
+# The caller sets span.end when the step is done. Returns None when we're not inside a traced request
+# (Handy for steps that start and end in different places, like streams and SQL event hooks)
+def add_span(name:str, kind:str, **attributes) -> Span | None:
+    parent = current_span.get()
+    if parent is None:
+        return None
+    child = Span(name, kind, attributes)
+    parent.children.append(child)
+    return child
+
+
+# Time a step of the request. Does nothing (besides the yield) when we're not inside a traced request
+# The yielded span lets you add attributes after the fact, like token counts once the LLM is done
+@contextmanager
+def span(name:str, kind:str, **attributes):
+    parent = current_span.get()
+    if parent is None:
+        yield None
+        return
+
+    child = Span(name, kind, attributes)
+    parent.children.append(child)
+    token = current_span.set(child)
+    try:
+        yield child
+    finally:
+        child.end = time.perf_counter()
+        current_span.reset(token)
+
+
+# Start the root span for a request (used by the middleware in main.py)
+def start_trace(method:str, path:str) -> tuple[str, Span, object]:
+    trace_id = uuid.uuid4().hex[:16]
+    root = Span(f"{method} {path}", "request", {"trace_id": trace_id})
+    return trace_id, root, current_span.set(root)
+
+
+# Finish a request's trace and decide whether to keep it
+def finish_trace(trace_id:str, root:Span, token, status_code:int):
+    root.end = time.perf_counter()
+    root.attributes["status_code"] = status_code
+    if token is not None: # None when the caller already reset it (streamed responses finish in another context)
+        current_span.reset(token)
+
+    trace = {"trace_id": trace_id, "duration_ms": round(root.duration_ms, 3), "root": root.to_dict(root.start)}
+
+    with _lock:
+        if random.random() < TRACE_SAMPLE_RATE:
+            _recent.append(trace)
+
+        # Keep the slowest N no matter what (min-heap, so the fastest of the slow ones gets bumped first)
+        if TRACE_KEEP_SLOWEST > 0:
+            entry = (root.duration_ms, trace_id, trace)
+            if len(_slowest) < TRACE_KEEP_SLOWEST:
+                heapq.heappush(_slowest, entry)
+            elif entry[0] > _slowest[0][0]:
+                heapq.heapreplace(_slowest, entry)
+
+
+# Look up one trace by ID (None if it was never kept or already fell out of the buffer)
+def get_trace(trace_id:str) -> dict | None:
+    with _lock:
+        for trace in _recent:
+            if trace["trace_id"] == trace_id:
+                return trace
+        for _, slow_id, trace in _slowest:
+            if slow_id == trace_id:
+                return trace
+    return None
+
+
+# Quick summary of the kept traces (newest first) and the slowest ones (slowest first)
+def list_traces() -> dict:
+    with _lock:
+        return {
+            "recent": [
+                {"trace_id": trace["trace_id"], "name": trace["root"]["name"], "duration_ms": trace["duration_ms"]}
+                for trace in reversed(_recent)
+            ],
+            "slowest": [
+                {"trace_id": trace["trace_id"], "name": trace["root"]["name"], "duration_ms": trace["duration_ms"]}
+                for _, _, trace in sorted(_slowest, reverse=True)
+            ]
+        }
+
+
+# Wrap a LangGraph node function so each run of the node shows up as a span
+# Nodes are also where a cancelled request stops - no point starting the next node (see cancellation_service)
+def traced_node(name:str, node):
+    def run_node(state):
+        check_cancelled()
+        with span(name, "node"):
+            return node(state)
+    return run_node
+
+
+# Hook SQLAlchemy so every SQL statement shows up as a span
+def instrument_engine(engine):
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        context._trace_span = add_span("sql", "sql", statement=statement[:200])
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_execute(conn, cursor, statement, parameters, context, executemany):
+        child = getattr(context, "_trace_span", None)
+        if child is not None:
+            child.end = time.perf_counter()
@@ -1,63 +1,276 @@
 import hashlib
+import logging
+import os
+import threading
+import time
+from contextvars import ContextVar
+from typing import Literal
 
+import chromadb
+import numpy as np
+from chromadb.errors import NotFoundError
 from langchain_chroma import Chroma
-from langchain_community.embeddings import OllamaEmbeddings
 from langchain_core.documents import Document
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+from langchain_core.embeddings import Embeddings
+from pydantic import BaseModel, Field
+
+from app.services import numpy_search_service
+from app.services.chunking_service import ChunkProfile, default_chunk_profile, split_text
+from app.services.ollama_client_service import PooledOllamaEmbeddings
+from app.services.tracing_service import span
 
 # This service will help us initialize and interact with a ChromaDB vector store
 # Remember, ChromaDB is just a type of VectorDB. There are others like pinecone
 
+logger = logging.getLogger(__name__)
+
 PERSIST_DIRECTORY = "app/chroma_store" # This is where our vectorDB will live
 
+# Wrapper around an embedding model that times every embedding call in the request's trace
+# (Chroma calls the embedding function for us, so wrapping it is how we see those calls too)
+class TracedEmbeddings(Embeddings):
+
+    def __init__(self, embeddings:Embeddings):
+        self.embeddings = embeddings
+
+    def embed_documents(self, texts:list[str]) -> list[list[float]]:
+        with span("embed_documents", "embedding", count=len(texts)):
+            return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text:str) -> list[float]:
+        with span("embed_query", "embedding", count=1):
+            return self.embeddings.embed_query(text)
+
+
+# MATRYOSHKA truncation: nomic-embed-text packs the most important info into the FIRST dimensions
+# So we can keep just the first 512/256/128 of its 768 dimensions (and re-normalize) with little quality loss
+# Smaller vectors = less storage and faster searches
+# nomic-embed-text v1.5 was trained for this with a LAYER NORM over the full 768 dims BEFORE slicing
+# (skip it and the truncated vectors lose a lot more quality than the model supports)
+# So the vectors passed in always have to be the FULL width ones
+def truncate_vectors(vectors:list[list[float]], dimension:int) -> list[list[float]]:
+    vectors = np.asarray(vectors, dtype=np.float32)
+
+    # Layer norm (no learned scale/shift): every row gets mean 0 and standard deviation 1
+    vectors = (vectors - vectors.mean(axis=1, keepdims=True)) / np.sqrt(vectors.var(axis=1, keepdims=True) + 1e-5)
+
+    # Then keep the first dimensions and L2 normalize
+    truncated = vectors[:, :dimension]
+    norms = np.linalg.norm(truncated, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (truncated / norms).tolist()
+
+
+# Wrapper that truncates whatever the inner embedding model returns (used for truncated collections)
+class MatryoshkaEmbeddings(Embeddings):
+
+    def __init__(self, embeddings:Embeddings, dimension:int):
+        self.embeddings = embeddings
+        self.dimension = dimension
+
+    def embed_documents(self, texts:list[str]) -> list[list[float]]:
+        return truncate_vectors(self.embeddings.embed_documents(texts), self.dimension)
+
+    def embed_query(self, text:str) -> list[float]:
+        return truncate_vectors([self.embeddings.embed_query(text)], self.dimension)[0]
+
+
 # The vector embedding model we installed
 # DIFFERENT from our LLM! This one specializes in turning text into vectors
-EMBEDDING = OllamaEmbeddings(model="nomic-embed-text")
+EMBEDDING_MODEL = "nomic-embed-text"
+EMBEDDING_FULL_DIMENSION = 768
+EMBEDDING = TracedEmbeddings(PooledOllamaEmbeddings(EMBEDDING_MODEL)) # Uses the shared embedding connection pool
+
+# Supported truncated sizes for nomic-embed-text
+MATRYOSHKA_DIMENSIONS = (512, 256, 128)
+
+# Embedding dimension for NEW collections (collections not listed here use the full 768)
+# Once a collection is created, its dimension is saved in the collection's metadata, and that always wins
+# To change the dimension of an existing collection, use the dimension_migration_service
+embedding_dimensions: dict[str, int] = {}
+
+
+# HNSW settings - HNSW is the graph index Chroma uses to find similar vectors fast (without checking every one)
+    # space - how distance is measured: "l2" (straight line), "cosine" or "ip" (inner product)
+    # M - how many links each vector gets in the graph. More = better recall, but a bigger index and slower builds
+    # construction_ef - how hard it looks for links while building. More = better graph, but slower builds
+    # search_ef - how hard it looks while searching. More = better recall, but slower queries
+# The defaults are Chroma's own defaults
+class IndexSettings(BaseModel):
+    space: Literal["l2", "cosine", "ip"] = "l2"
+    M: int = Field(default=16, gt=1)
+    construction_ef: int = Field(default=100, gt=0)
+    search_ef: int = Field(default=100, gt=0)
+
+    # Chroma reads these "hnsw:" keys from the collection metadata when it creates the collection
+    def to_metadata(self) -> dict:
+        return {f"hnsw:{name}": value for name, value in self.model_dump().items()}
+
+
+# Index settings for NEW collections (collections not listed here get the defaults)
+# Like the embedding dimension, they're saved with the collection when it's created
+# Only search_ef can be changed after that (see set_search_ef) - the rest are baked into the index
+# Use the hnsw_benchmark to find good settings for a collection
+index_settings: dict[str, IndexSettings] = {}
+
+# Which backend search() uses by default: "chroma" or "numpy" (see numpy_search_service)
+# Collections that were never exported to NumPy always fall back to Chroma
+SEARCH_BACKEND = os.getenv("VECTOR_SEARCH_BACKEND", "chroma")
+
+# Query vectors that were already embedded in a batch, keyed by query text (the bulk query runner sets these)
+# search() uses them instead of making its own embedding call. A ContextVar, so each query only sees its own
+precomputed_query_vectors: ContextVar[dict[str, list[float]] | None] = ContextVar("precomputed_query_vectors", default=None)
 
 # The actual Vector store (which stores our embeddings and lets us interact with them)
 # We will initialize it as a dict which lets us manage multiple stores at once
 vector_store: dict[str, Chroma] = {}
 
+# Opening Chroma from several threads at once (like the bulk query runner's workers) can break its client setup,
+# so only one thread creates a store at a time
+_vector_store_lock = threading.Lock()
+
+# A cached store points at one collection ID. If ANOTHER process replaces the collection (like a dimension
+# migration with replace=True, which deletes it and renames the new one into its place), that ID is gone
+# So every STORE_CHECK_SECONDS we make sure the name still points at the same ID, and rebuild the store if not
+# (search() doesn't even wait for that - it re-checks right away if Chroma says the collection doesn't exist)
+STORE_CHECK_SECONDS = 5
+_store_checked: dict[str, float] = {} # collection -> time.monotonic() of the last check
+
+
+# Is the cached store still pointing at the collection that has its name?
+def _is_current(store:Chroma) -> bool:
+    try:
+        return store._client.get_collection(store._collection.name).id == store._collection.id
+    except NotFoundError:
+        return False
+
+
 # A function that gets an instance of the chosen Vector Store
 # Similar to how we needed get_db() in the db_connection service
-def get_vector_store(collection:str) -> Chroma:
+# embedding_dimension and settings only matter if the collection doesn't exist yet (otherwise the saved ones are used)
+# refresh=True checks right now that the cached store still points at the current collection
+def get_vector_store(collection:str, embedding_dimension:int=None, settings:IndexSettings=None,
+                     refresh:bool=False) -> Chroma:
 
     # Get (or create) the vector store from the global dict (vector_store)
-    if collection not in vector_store:
-        vector_store[collection] = Chroma(
-            collection_name = collection, # remember a collection is just a grouping of embeddings
-            embedding_function = EMBEDDING,
-            persist_directory = PERSIST_DIRECTORY
-        )
+    with _vector_store_lock:
+        now = time.monotonic()
+        if collection in vector_store and (refresh or now - _store_checked.get(collection, 0.0) > STORE_CHECK_SECONDS):
+            if not _is_current(vector_store[collection]):
+                del vector_store[collection] # Replaced (or deleted) by someone else - build it again below
+            _store_checked[collection] = now
+
+        if collection not in vector_store:
+
+            # Everything that gets saved with the collection when it's created (ignored if it already exists)
+            metadata = {}
+            dimension = embedding_dimension or embedding_dimensions.get(collection)
+            if dimension:
+                metadata["embedding_dimension"] = dimension
+            settings = settings or index_settings.get(collection)
+            if settings:
+                metadata.update(settings.to_metadata())
+
+            store = Chroma(
+                collection_name = collection, # remember a collection is just a grouping of embeddings
+                embedding_function = EMBEDDING,
+                persist_directory = PERSIST_DIRECTORY,
+                collection_metadata = metadata or None
+            )
+
+            # Truncated collection? Then rebuild the store so everything it embeds gets truncated too
+            saved_dimension = get_embedding_dimension(store)
+            if saved_dimension != EMBEDDING_FULL_DIMENSION:
+                store = Chroma(
+                    collection_name = collection,
+                    embedding_function = MatryoshkaEmbeddings(EMBEDDING, saved_dimension),
+                    persist_directory = PERSIST_DIRECTORY
+                )
+
+            vector_store[collection] = store
+            _store_checked[collection] = now
+
+        # Return the vector store instance, which either already existed or got created in the if statement
+        return vector_store[collection]
+
+
+# Does a collection exist? Asks Chroma directly, so unlike get_vector_store() it never CREATES the collection
+# (PersistentClient hands back the same shared client the stores use for this folder)
+def collection_exists(collection:str) -> bool:
+    with _vector_store_lock:
+        client = chromadb.PersistentClient(path=PERSIST_DIRECTORY)
+    try:
+        client.get_collection(collection)
+        return True
+    except NotFoundError:
+        return False
+
+
+# The embedding dimension a collection was created with (768 if it isn't truncated)
+def get_embedding_dimension(store:Chroma) -> int:
+    return (store._collection.metadata or {}).get("embedding_dimension") or EMBEDDING_FULL_DIMENSION
+
+
+# The HNSW settings a collection's index is actually using (Chroma keeps these in the collection's configuration)
+def get_index_settings(store:Chroma) -> IndexSettings:
+    hnsw = (store._collection.configuration_json or {}).get("hnsw") or {}
+    defaults = IndexSettings()
+    return IndexSettings(
+        space=hnsw.get("space", defaults.space),
+        M=hnsw.get("max_neighbors", defaults.M),
+        construction_ef=hnsw.get("ef_construction", defaults.construction_ef),
+        search_ef=hnsw.get("ef_search", defaults.search_ef)
+    )
+
+
+# Change how hard an existing collection's index searches (the one HNSW setting that can change after creation)
+# NOTE: Chroma keeps an index loaded in memory once it's been searched, and that copy keeps its old search_ef
+# So the new value is saved right away, but it kicks in the next time the index gets loaded (server restart)
+def set_search_ef(collection:str, search_ef:int) -> IndexSettings:
+    store = get_vector_store(collection)
+    store._collection.modify(configuration={"hnsw": {"ef_search": search_ef}})
+    return get_index_settings(store)
+
+
+# How a collection's text gets chunked (see chunking_service)
+# A saved profile lives in the collection's metadata, so it survives restarts and every uvicorn worker agrees on it
+# We read the metadata fresh from Chroma (not the cached store), in case another worker just changed it
+def get_chunk_profile(collection:str) -> ChunkProfile:
+    store = get_vector_store(collection)
+    metadata = store._client.get_collection(collection).metadata
+    return ChunkProfile.from_metadata(metadata) or default_chunk_profile(collection)
 
-    # Return the vector store instance, which either already existed or got created in the if statement
-    return vector_store[collection]
 
+# Save a new chunk profile for a collection (only affects text ingested from now on)
+def set_chunk_profile(collection:str, profile:ChunkProfile) -> ChunkProfile:
+    store = get_vector_store(collection)
 
+    # modify() REPLACES the whole metadata, so keep what's already there (like the embedding dimension)
+    # The "hnsw:" keys get left out - Chroma refuses them after creation (even unchanged), and the index keeps
+    # its settings in the collection's configuration anyway
+    metadata = store._client.get_collection(collection).metadata or {}
+    metadata = {key: value for key, value in metadata.items() if not key.startswith("hnsw:")}
+    metadata.update(profile.to_metadata())
+    store._collection.modify(metadata=metadata)
+    return profile
 
-# A function that ingests documents into the vector store
-# (this is where text gets turned into vectors and stored in the DB)
-def ingest_text(collection:str, text:str):
 
-    """
-    This is gonna be a lot - to ingest text we need to:
-        1. Clean up the input (remove whitespace etc.)
-        2. "Chunk" the data. Split it into smaller pieces for better embedding
-        3. Create metadata for the chunks (IDs, importantly)
-        4. Embed the chunks (turn them into vectors)
-        5. Store the vectors and metadata in the DB
-    """
+# A function that turns raw text into chunk Documents + their IDs
+# All ingestion goes through the background jobs now (see ingest_job_service), and to ingest text they:
+    # 1. Clean up the input (remove whitespace etc.)
+    # 2. "Chunk" the data. Split it into smaller pieces for better embedding
+    # 3. Create metadata for the chunks (IDs, importantly)
+    # 4. Embed the chunks (turn them into vectors), a batch at a time
+    # 5. Store the vectors and metadata in the DB, then call after_ingest()
+# Steps 1-3 happen here
+def prepare_chunks(collection:str, text:str) -> tuple[list[Document], list[str]]:
 
     # Clean the text - no whitespace
     text = text.strip()
 
-    # Chunk the text using a LangChain Transformer, which returns the chunks as a list of stings \
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size = 500, # Each chunk will contain 500 characters
-        chunk_overlap = 100, # Each chunk will overlap with its neighbor by 100 chars. Good for retaining context
-        separators=["\n\n", "\n"] # Helps the splitter with chunking - allows for line breaks
-    )
-    chunks = splitter.split_text(text)
+    # Chunk the text with the chunking service, which uses the collection's chunk profile
+    # (token-sized chunks that break on sentence boundaries - see chunking_service)
+    chunks = split_text(text, get_chunk_profile(collection))
 
     # Fill this list with the enumerated chunks we'll make below
     documents = []
@@ -80,30 +293,111 @@ def ingest_text(collection:str, text:str):
         # Generate and attach the IDs to the chunk_ids list
         chunk_ids.append(ID)
 
-    # Get the vector store instance for the collection passed into the function
-    store = get_vector_store(collection)
-
     # Turn the documents into a list of LangChain Document object (vectorDB needs this)
     vector_docs = [
         Document(page_content=doc["text"]) for doc in documents
     ]
 
-    # Ingest the documents! (turning them into vectors and storing them)
-    store.add_documents(vector_docs, ids=chunk_ids)
+    return vector_docs, chunk_ids
+
+
+# Anything that needs to happen after new chunks land in a collection
+# coalesce=True (the ingest jobs) waits EXPORT_COALESCE_SECONDS before re-exporting, so a burst of jobs shares ONE
+# export. Bulk loads (snapshot imports, migrations) re-export right away - they're one big write anyway
+def after_ingest(collection:str, coalesce:bool=False):
 
-    # Return a message with amount of chunks ingested
-    return len(documents)
+    # Only collections that are served by the NumPy backend get re-exported (so the new chunks are searchable)
+    # NOTE: a re-export reads the WHOLE collection out of Chroma, so it costs O(N) in the collection's size
+    # (fine for the small/medium collections the NumPy backend is meant for - big ones should stay on Chroma)
+    if not numpy_search_service.is_exported(collection):
+        return
+    if coalesce:
+        _schedule_numpy_export(collection)
+    else:
+        _export_numpy_now(collection)
+
+
+# How long an ingest job's re-export waits for other jobs to ride along with it
+EXPORT_COALESCE_SECONDS = float(os.getenv("NUMPY_EXPORT_COALESCE_SECONDS", "5"))
+
+# Collections with a re-export waiting to run (collection -> the timer that'll run it)
+_pending_exports: dict[str, threading.Timer] = {}
+_pending_exports_lock = threading.Lock()
+
+
+def _export_numpy_now(collection:str):
+    store = get_vector_store(collection)
+    numpy_search_service.export_collection(collection, store, get_index_settings(store).space)
+
+
+# If an export is already waiting, this ingest just rides along with it
+# (an ingest that lands while the export is RUNNING schedules a new one, since the running one may have missed it)
+def _schedule_numpy_export(collection:str):
+    with _pending_exports_lock:
+        if collection in _pending_exports:
+            return
+        timer = threading.Timer(EXPORT_COALESCE_SECONDS, _run_scheduled_export, args=(collection,))
+        timer.daemon = True
+        _pending_exports[collection] = timer
+    timer.start()
+
+
+def _run_scheduled_export(collection:str):
+    with _pending_exports_lock:
+        _pending_exports.pop(collection, None)
+    try:
+        _export_numpy_now(collection)
+    except Exception:
+        logger.exception("Re-exporting collection %s to NumPy failed", collection)
+
+
+# Run every waiting re-export right now (the app calls this on shutdown, so none get lost)
+def flush_numpy_exports():
+    with _pending_exports_lock:
+        pending = list(_pending_exports.items())
+    for collection, timer in pending:
+        timer.cancel()
+        _run_scheduled_export(collection)
 
 
 # A function that performs a similarity search on the vector store
 # Take the user input, turn it into a vector, and compare it to the vectors in the specified collection
-def search(collection:str, query:str, k:int=6):
+def search(collection:str, query:str, k:int=6, backend:str=None):
+    try:
+        return _search(collection, query, k, backend)
+    except NotFoundError:
+        # The collection got replaced (by a migration in another process) since we cached it
+        # Re-resolve it and try ONCE more - the query gets re-embedded since the new one might be a different width
+        get_vector_store(collection, refresh=True)
+        return _search(collection, query, k, backend)
+
+
+def _search(collection:str, query:str, k:int, backend:str):
 
     # Get the vector store instance
     store = get_vector_store(collection)
 
+    # Turn the query into a vector (we do it ourselves so the embedding and the lookup get timed separately)
+    # store.embeddings is the collection's embedding function, so it's already truncated if it needs to be
+    precomputed = precomputed_query_vectors.get()
+    if precomputed and query in precomputed:
+        # Already embedded in a batch - just truncate it to the collection's dimension if we need to
+        query_vector = precomputed[query]
+        dimension = get_embedding_dimension(store)
+        if dimension != EMBEDDING_FULL_DIMENSION:
+            query_vector = truncate_vectors([query_vector], dimension)[0]
+    else:
+        query_vector = store.embeddings.embed_query(query)
+
+    # Use the NumPy backend if it was asked for AND the collection has been exported
+    backend = backend or SEARCH_BACKEND
+    if backend == "numpy" and numpy_search_service.is_exported(collection):
+        with span("numpy.search", "vector_query", collection=collection, k=k):
+            return numpy_search_service.search_vector(collection, query_vector, k)
+
     # Get and save the results of the similarity search (finding the most relevant docs)
-    results = store.similarity_search_with_score(query, k=k)
+    with span("chroma.query", "vector_query", collection=collection, k=k):
+        results = store.similarity_search_by_vector_with_relevance_scores(query_vector, k=k)
 
     # Return the results
     return [
@@ -112,4 +406,103 @@ def search(collection:str, query:str, k:int=6):
             "score": result[1] # The similarity score (lower is more similar)
         }
         for result in results
-    ]
\ No newline at end of file
+    ]
+
+
+# A function that performs MANY similarity searches at once (used by the batch search endpoint)
+# Each query is a dict like {"query": "...", "k": 5, "collection": "dino_docs"}
+    # k and collection are optional - they fall back to default_k and default_collection
+# Everything that can fail up front (bad k, bad collection names, the embedding call) happens BEFORE this returns,
+# so the batch endpoint can still answer with a proper error status (ValueError/ChromaError for bad input)
+# It returns a GENERATOR that yields (index, results, error) for each query as soon as its collection is done
+    # error is None, unless searching that query's collection failed (then results is None)
+def search_many(queries:list[dict], default_collection:str=None, default_k:int=6, backend:str=None):
+
+    backend = backend or SEARCH_BACKEND
+
+    # Group the query indexes by collection, so each collection only gets queried once
+    groups: dict[str, list[int]] = {}
+    for index, query in enumerate(queries):
+        if query.get("k") is not None and query["k"] <= 0:
+            raise ValueError(f"Query {index} has k={query['k']} (k must be at least 1)")
+        collection = query.get("collection") or default_collection
+        if collection is None:
+            raise ValueError(f"Query {index} has no collection (and there's no default collection)")
+        groups.setdefault(collection, []).append(index)
+    if default_k <= 0:
+        raise ValueError("k must be at least 1")
+
+    # Open every collection now - a bad collection name raises here instead of halfway through the stream
+    for collection in groups:
+        get_vector_store(collection)
+
+    # Embed ALL the queries up front with one embed_documents() call
+    # NOTE: that's still one /api/embeddings request per query - they just run side by side over the embedding
+    # pool's connections (EMBEDDING_POOL_SIZE) instead of one after the other. We can't use the batched /api/embed
+    # endpoint because it L2 normalizes its vectors, and those wouldn't match the raw vectors already stored
+    vectors = EMBEDDING.embed_documents([query["query"] for query in queries])
+
+    return _search_groups(queries, groups, vectors, default_k, backend)
+
+
+# The streaming half of search_many - searches one collection at a time
+# A collection that fails still gets an answer for each of its queries (an error), so the stream never just stops
+def _search_groups(queries:list[dict], groups:dict[str, list[int]], vectors:list, default_k:int, backend:str):
+
+    for collection, indexes in groups.items():
+        ks = [queries[index].get("k") or default_k for index in indexes]
+        group_vectors = [vectors[index] for index in indexes]
+
+        try:
+            try:
+                group_results = _search_group(collection, group_vectors, ks, backend)
+            except NotFoundError:
+                # Same as search() - the collection got replaced since we cached it, so re-resolve and retry once
+                get_vector_store(collection, refresh=True)
+                group_results = _search_group(collection, group_vectors, ks, backend)
+        except Exception as e:
+            for index in indexes:
+                yield index, None, f"Search failed for collection '{collection}': {e}"
+            continue
+
+        for index, results in zip(indexes, group_results):
+            yield index, results, None
+
+
+# Search one collection with a group of full-width query vectors (each with its own k)
+def _search_group(collection:str, group_vectors:list, ks:list[int], backend:str):
+
+    store = get_vector_store(collection)
+
+    # Truncated collection? Truncate this group's query vectors to match (no extra embedding call needed)
+    dimension = get_embedding_dimension(store)
+    if dimension != EMBEDDING_FULL_DIMENSION:
+        group_vectors = truncate_vectors(group_vectors, dimension)
+
+    # NumPy backend: one matrix multiply for the whole group
+    if backend == "numpy" and numpy_search_service.is_exported(collection):
+        with span("numpy.search_many", "vector_query", collection=collection, queries=len(ks)):
+            return numpy_search_service.search_vectors(collection, group_vectors, ks)
+
+    # Chroma backend: one multi-query lookup for the whole group
+    # We ask for the biggest k, then trim each query's results down to its own k
+    with span("chroma.query_many", "vector_query", collection=collection, queries=len(ks)):
+        raw = store._collection.query(
+            query_embeddings=group_vectors,
+            n_results=max(ks),
+            include=["documents", "distances"]
+        )
+    return [
+        [
+            {"text": text, "score": distance}
+            for text, distance in zip(raw["documents"][row][:k], raw["distances"][row][:k])
+        ]
+        for row, k in enumerate(ks)
+    ]
+
+
+# Export a collection to the NumPy search backend (memory-mapped float32 matrices)
+# After this, search(..., backend="numpy") will skip Chroma for this collection
+def export_to_numpy(collection:str):
+    store = get_vector_store(collection)
+    return numpy_search_service.export_collection(collection, store, get_index_settings(store).space)